@@ -0,0 +1,288 @@
+import math
+from datetime import datetime, timezone
+
+from config import ACTIVITY_FETCH_PAGE_SIZE, ACTIVITY_FETCH_KEY_CHUNK_SIZE
+import structured_log as log
+
+# high-water mark を記録する活動データのテーブル
+ACTIVITY_SOURCES = ("messages", "posts", "post_messages_to_ai")
+
+
+def chunked(items, size):
+    """リストを size 件ずつに分割する"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def iter_pages(build_query, page_size=ACTIVITY_FETCH_PAGE_SIZE):
+    """range 指定でページングしながらクエリ結果を1ページずつ返す"""
+    offset = 0
+    while True:
+        res = build_query().range(offset, offset + page_size - 1).execute()
+        page = res.data or []
+        yield page
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+def _fetch_paginated(build_query, page_size=ACTIVITY_FETCH_PAGE_SIZE):
+    """range 指定でページングしながらクエリ結果を全件取得する"""
+    rows = []
+    for page in iter_pages(build_query, page_size):
+        rows.extend(page)
+    return rows
+
+
+def _fetch_window_rows(supabase, table, start_time_str, end_time_str, key_column=None, keys=None):
+    """
+    指定テーブルの時間範囲内の行を取得する。
+    keys が指定された場合は key_column で IN 句のチャンクに分けて取得する。
+    """
+    def base_query():
+        return supabase.table(table) \
+            .select('*') \
+            .gte('created_at', start_time_str) \
+            .lte('created_at', end_time_str) \
+            .order('created_at') \
+            .order('id')
+
+    if keys is None:
+        return _fetch_paginated(base_query)
+
+    rows = []
+    for chunk in chunked(list(keys), ACTIVITY_FETCH_KEY_CHUNK_SIZE):
+        rows.extend(_fetch_paginated(lambda chunk=chunk: base_query().in_(key_column, chunk)))
+    return rows
+
+
+def _fetch_rows_by_keys(supabase, table, key_column, keys):
+    """key_column が keys のいずれかに一致する行を IN 句のチャンクに分けて取得する"""
+    rows = []
+    for chunk in chunked(list(keys), ACTIVITY_FETCH_KEY_CHUNK_SIZE):
+        rows.extend(_fetch_paginated(
+            lambda chunk=chunk: supabase.table(table).select('*').in_(key_column, chunk).order('id')
+        ))
+    return rows
+
+
+def parse_timestamp(value):
+    """created_at などの ISO 形式の文字列を比較可能な datetime にする (タイムゾーンなしは UTC とみなす)"""
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=timezone.utc)
+
+
+def position(created_at, row_id=None):
+    """
+    処理順の位置 (created_at, id)。high-water mark との比較に使う。
+    id が None の位置は、その時刻までの行をすべて含む (取得範囲の終端まで処理済みであることを表す)。
+    """
+    return parse_timestamp(created_at), math.inf if row_id is None else row_id
+
+
+def _dedupe_sorted(rows):
+    """ID の重複を除き、処理順 (created_at, id) に並べた行のリスト"""
+    return sorted({row['id']: row for row in rows}.values(), key=lambda row: position(row['created_at'], row['id']))
+
+
+def fetch_user_ids(supabase):
+    """全ユーザーのIDを取得する"""
+    rows = _fetch_paginated(lambda: supabase.table('users').select('user_id').order('user_id'))
+    return [row['user_id'] for row in rows]
+
+
+def load_activity_window(supabase, start_time_str, end_time_str, user_ids=None):
+    """
+    messages / posts / post_messages_to_ai を期間全体でまとめて取得し、ユーザーごとにグループ化する。
+    user_ids を指定しない場合はテーブル全体を1回ずつ走査し、指定した場合は user_id のチャンク単位で取得する。
+    戻り値は活動のあったユーザーのみを含む {user_id: {"messages": [...], "posts": [...], "post_messages_to_ai": [...]}}。
+    """
+    target_user_ids = set(user_ids) if user_ids is not None else None
+
+    messages = _fetch_window_rows(supabase, 'messages', start_time_str, end_time_str,
+                                  key_column='user_id', keys=user_ids)
+    posts = _fetch_window_rows(supabase, 'posts', start_time_str, end_time_str,
+                               key_column='user_id', keys=user_ids)
+
+    post_owner = {post['id']: post['user_id'] for post in posts}
+    if user_ids is None:
+        post_messages_to_ai = _fetch_window_rows(supabase, 'post_messages_to_ai', start_time_str, end_time_str)
+    else:
+        post_messages_to_ai = _fetch_window_rows(supabase, 'post_messages_to_ai', start_time_str, end_time_str,
+                                                 key_column='post_id', keys=list(post_owner.keys()))
+
+    activity_by_user = {}
+
+    def bucket(user_id):
+        if user_id not in activity_by_user:
+            activity_by_user[user_id] = {"messages": [], "posts": [], "post_messages_to_ai": []}
+        return activity_by_user[user_id]
+
+    for msg in messages:
+        if target_user_ids is None or msg['user_id'] in target_user_ids:
+            bucket(msg['user_id'])["messages"].append(msg)
+    for post in posts:
+        if target_user_ids is None or post['user_id'] in target_user_ids:
+            bucket(post['user_id'])["posts"].append(post)
+    # 期間内の投稿に紐づくAIメッセージのみを対象にする
+    for ai_msg in post_messages_to_ai:
+        owner = post_owner.get(ai_msg['post_id'])
+        if owner is not None and (target_user_ids is None or owner in target_user_ids):
+            bucket(owner)["post_messages_to_ai"].append(ai_msg)
+
+    log.info("Bulk loaded activity window", messages=len(messages), posts=len(posts),
+             post_messages_to_ai=len(post_messages_to_ai), active_users=len(activity_by_user))
+    return activity_by_user
+
+
+def load_new_activity(supabase, watermarks, default_start_str, floor_start_str, end_time_str, user_ids,
+                      by_user_ids=False):
+    """
+    user_ids の high-water mark より後の messages / posts / post_messages_to_ai だけを取得し、ユーザーごとにグループ化する。
+    watermarks は {user_id: {source: (created_at, id)}}。位置のないテーブルは default_start_str 以降を、
+    floor_start_str より古い位置は floor_start_str 以降を対象にする。
+    ほとんどのユーザーは前回の実行の終端まで処理済みなので、最も新しい開始位置からはまとめて取得し、
+    それより前から取得する必要のあるユーザー (失敗・保留したユーザーや位置のないユーザー) の分だけを user_id で絞って遡る。
+    by_user_ids が True の場合は、まとめて取得する分も user_id のチャンク単位で取得し、AIメッセージは
+    対象ユーザーの floor_start_str 以降の投稿の ID で絞り込む。
+    新しいAIメッセージが以前の投稿に付いた場合、その投稿は会話の文脈として "context_posts" に入れる。
+    戻り値の形式は load_activity_window と同じ (加えて "context_posts" と、ユーザーの取得開始位置 "window_start" を含む)。
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    floor = (parse_timestamp(floor_start_str), -math.inf)
+    default_start = (parse_timestamp(default_start_str), -math.inf)
+
+    def start_position(user_id, source):
+        mark = watermarks.get(user_id, {}).get(source)
+        if mark is None:
+            return default_start
+        return max(position(*mark), floor)
+
+    starts = {user_id: min(start_position(user_id, source) for source in ACTIVITY_SOURCES) for user_id in user_ids}
+    bulk_start = max(starts.values())[0]
+    bulk_start_str = bulk_start.isoformat()
+    lagging_user_ids = [user_id for user_id in user_ids if starts[user_id][0] < bulk_start]
+    num_clamped = sum(1 for start in starts.values() if start == floor)
+
+    def is_new(user_id, source, row):
+        return user_id in starts and position(row['created_at'], row['id']) > start_position(user_id, source)
+
+    lagging_since = None
+    if lagging_user_ids:
+        lagging_since = min(starts[user_id] for user_id in lagging_user_ids)[0].isoformat()
+    messages = _fetch_window_rows(supabase, 'messages', bulk_start_str, end_time_str,
+                                  key_column='user_id', keys=user_ids if by_user_ids else None)
+    if lagging_user_ids:
+        messages += _fetch_window_rows(supabase, 'messages', lagging_since, bulk_start_str,
+                                       key_column='user_id', keys=lagging_user_ids)
+
+    if by_user_ids:
+        # 対象ユーザーの遡れる範囲の投稿を先に取得し、AIメッセージはその投稿の ID で絞り込む
+        # (ユーザーで絞らずに取得すると、他のシャードのユーザーの投稿まで ID で引くことになる)
+        posts = _fetch_window_rows(supabase, 'posts', floor_start_str, end_time_str,
+                                   key_column='user_id', keys=user_ids)
+        post_messages_to_ai = _fetch_window_rows(supabase, 'post_messages_to_ai', lagging_since or bulk_start_str,
+                                                 end_time_str, key_column='post_id', keys=[post['id'] for post in posts])
+    else:
+        posts = _fetch_window_rows(supabase, 'posts', bulk_start_str, end_time_str)
+        # AIメッセージは post_id でしか絞り込めないため、まとめて取得する分はユーザーで絞らずに取得する
+        post_messages_to_ai = _fetch_window_rows(supabase, 'post_messages_to_ai', bulk_start_str, end_time_str)
+        if lagging_user_ids:
+            # 遡る分のAIメッセージは、遡れる範囲の投稿の ID で絞り込む
+            lagging_posts = _fetch_window_rows(supabase, 'posts', floor_start_str, bulk_start_str,
+                                               key_column='user_id', keys=lagging_user_ids)
+            posts += lagging_posts
+            post_messages_to_ai += _fetch_window_rows(supabase, 'post_messages_to_ai', lagging_since, bulk_start_str,
+                                                      key_column='post_id',
+                                                      keys=[post['id'] for post in lagging_posts])
+    # 両方の取得範囲の境目の行は2回取得されるため ID で重複を除き、時刻順に並べ直す
+    messages = _dedupe_sorted(messages)
+    post_messages_to_ai = _dedupe_sorted(post_messages_to_ai)
+    posts_by_id = {post['id']: post for post in _dedupe_sorted(posts)}
+    if not by_user_ids:
+        # 取得範囲より前の投稿に付いたAIメッセージは、投稿を ID で引いて持ち主を調べる
+        missing_post_ids = sorted({ai_msg['post_id'] for ai_msg in post_messages_to_ai} - posts_by_id.keys())
+        for post in _fetch_rows_by_keys(supabase, 'posts', 'id', missing_post_ids):
+            posts_by_id[post['id']] = post
+
+    activity_by_user = {}
+
+    def bucket(user_id):
+        if user_id not in activity_by_user:
+            activity_by_user[user_id] = {"messages": [], "posts": [], "post_messages_to_ai": [], "context_posts": [],
+                                         "window_start": starts[user_id][0].isoformat()}
+        return activity_by_user[user_id]
+
+    for msg in messages:
+        if is_new(msg['user_id'], 'messages', msg):
+            bucket(msg['user_id'])["messages"].append(msg)
+    new_post_ids = set()
+    for post in posts_by_id.values():
+        if is_new(post['user_id'], 'posts', post):
+            bucket(post['user_id'])["posts"].append(post)
+            new_post_ids.add(post['id'])
+    context_post_ids = set()
+    for ai_msg in post_messages_to_ai:
+        post = posts_by_id.get(ai_msg['post_id'])
+        if post is None or not is_new(post['user_id'], 'post_messages_to_ai', ai_msg):
+            continue
+        activity = bucket(post['user_id'])
+        activity["post_messages_to_ai"].append(ai_msg)
+        if post['id'] not in new_post_ids and post['id'] not in context_post_ids:
+            activity["context_posts"].append(post)
+            context_post_ids.add(post['id'])
+
+    log.info("Bulk loaded new activity", since=bulk_start_str, until=end_time_str, messages=len(messages),
+             posts=len(posts_by_id), post_messages_to_ai=len(post_messages_to_ai),
+             active_users=len(activity_by_user), lagging_users=len(lagging_user_ids), lagging_since=lagging_since,
+             clamped_watermarks=num_clamped)
+    return activity_by_user
+
+
+def build_conversation_json(user_id, activity):
+    """ユーザーの活動データから各サービスに渡す会話再現JSONを組み立てる"""
+    # messages: room_idごとにまとめ、created_at順
+    messages_by_room = {}
+    for msg in activity["messages"]:
+        room_id = msg['room_id']
+        if room_id not in messages_by_room:
+            messages_by_room[room_id] = []
+        messages_by_room[room_id].append({
+            "role": msg['role'],
+            "content": msg['content'],
+            "created_at": msg['created_at']
+        })
+    # posts, post_messages_to_ai: post_idで紐付け、created_at順
+    post_ai_by_post = {}
+    for ai_msg in activity["post_messages_to_ai"]:
+        post_id = ai_msg['post_id']
+        if post_id not in post_ai_by_post:
+            post_ai_by_post[post_id] = []
+        post_ai_by_post[post_id].append({
+            "role": ai_msg['role'],
+            "content": ai_msg['content'],
+            "created_at": ai_msg['created_at']
+        })
+    # postsごとにユーザーとAIの会話を再現 (context_posts は新しいAIメッセージが付いた以前の投稿)
+    posts_conversations = []
+    for post in activity.get("context_posts", []) + activity["posts"]:
+        conv = []
+        conv.append({
+            "role": "user",
+            "comment": post['comment'],
+            "created_at": post['created_at']
+        })
+        ai_msgs = post_ai_by_post.get(post['id'], [])
+        conv.extend(sorted(ai_msgs, key=lambda x: x['created_at']))
+        posts_conversations.append({
+            "post_id": post['id'],
+            "conversation": conv
+        })
+    # 全体json
+    return {
+        "user_id": user_id, # ユーザーIDをjsonに含める
+        "messages_by_room": messages_by_room,
+        "posts_conversations": posts_conversations
+    }
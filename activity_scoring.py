@@ -0,0 +1,93 @@
+from dataclasses import dataclass
+
+from config import (
+    ACTIVITY_SKIP_MAX_SCORE,
+    ACTIVITY_TEMPLATE_MAX_SCORE,
+    ACTIVITY_SCORE_CHARS_PER_POINT,
+    ACTIVITY_SCORE_AI_REPLY_WEIGHT,
+)
+
+# 定型レポートに載せるユーザーの発言の件数と、1件あたりの最大文字数
+TEMPLATE_MAX_TOPICS = 3
+TEMPLATE_TOPIC_CHARS = 60
+
+# 定型レポートの日に advanced_report として保存する文面
+TEMPLATE_INSIGHTS_TEXT = "本日は学習の記録が少なかったため、学習アドバイスの生成は行いませんでした。"
+
+
+@dataclass
+class ActivityScore:
+    """1ユーザー分の会話再現JSONから数えた活動量"""
+    user_messages: int
+    ai_replies: int
+    posts: int
+    posts_with_ai: int
+    user_chars: int
+
+    @property
+    def score(self):
+        return (self.user_messages + self.posts + self.ai_replies * ACTIVITY_SCORE_AI_REPLY_WEIGHT
+                + self.user_chars / ACTIVITY_SCORE_CHARS_PER_POINT)
+
+    def as_dict(self):
+        return {"score": round(self.score, 2), "user_messages": self.user_messages, "ai_replies": self.ai_replies,
+                "posts": self.posts, "posts_with_ai": self.posts_with_ai, "user_chars": self.user_chars}
+
+
+def score_activity(conversation_json):
+    """build_conversation_json が組み立てた messages_by_room と posts_conversations から活動量を数える"""
+    user_messages = ai_replies = posts = posts_with_ai = user_chars = 0
+    for messages in conversation_json["messages_by_room"].values():
+        for msg in messages:
+            if msg["role"] == "user":
+                user_messages += 1
+                user_chars += len(msg["content"] or "")
+            else:
+                ai_replies += 1
+    for post in conversation_json["posts_conversations"]:
+        # 先頭は投稿本文、続く発言はAIとのやりとり
+        comment, *replies = post["conversation"]
+        posts += 1
+        user_chars += len(comment["comment"] or "")
+        if replies:
+            posts_with_ai += 1
+        for reply in replies:
+            if reply["role"] == "user":
+                user_messages += 1
+                user_chars += len(reply["content"] or "")
+            else:
+                ai_replies += 1
+    return ActivityScore(user_messages, ai_replies, posts, posts_with_ai, user_chars)
+
+
+def fast_path_for(score):
+    """活動量に応じた簡易処理を返す。"skip" (処理しない)・"template" (定型レポートのみ)・None (通常の生成)"""
+    if score.score <= ACTIVITY_SKIP_MAX_SCORE:
+        return "skip"
+    if score.score <= ACTIVITY_TEMPLATE_MAX_SCORE:
+        return "template"
+    return None
+
+
+def _user_topics(conversation_json):
+    """定型レポートに載せるユーザーの発言・投稿を時刻順に返す"""
+    entries = [(msg["created_at"], msg["content"])
+               for messages in conversation_json["messages_by_room"].values()
+               for msg in messages if msg["role"] == "user"]
+    entries += [(post["conversation"][0]["created_at"], post["conversation"][0]["comment"])
+                for post in conversation_json["posts_conversations"]]
+    return [" ".join((text or "").split()) for _, text in sorted(entries, key=lambda entry: entry[0])]
+
+
+def render_template_report(conversation_json, score):
+    """Gemini を使わずに、活動の件数とユーザーの発言の抜粋から簡単なレポートを作る"""
+    lines = [f"本日は質問・発言が{score.user_messages}件、投稿が{score.posts}件、AIからの返答が{score.ai_replies}件ありました。"]
+    topics = [text for text in _user_topics(conversation_json) if text][:TEMPLATE_MAX_TOPICS]
+    if topics:
+        lines.append("")
+        lines.append("主な内容:")
+        for text in topics:
+            lines.append("- " + (text[:TEMPLATE_TOPIC_CHARS] + "…" if len(text) > TEMPLATE_TOPIC_CHARS else text))
+    lines.append("")
+    lines.append("学習の記録が少なかったため、詳しいレポートと問題の作成は行いませんでした。")
+    return "\n".join(lines)
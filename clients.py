@@ -0,0 +1,91 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google import genai
+from supabase import create_client
+
+import structured_log as log
+import utils
+from config import SECRET_URL_ID, SECRET_KEY_ID, GEMINI_API_KEY_SECRET_ID, SECRET_ENV_OVERRIDES, SECRET_CACHE_TTL_SECONDS
+
+
+class ClientRegistry:
+    """
+    プロセス全体で共有するシークレット・Supabase・Gemini クライアントの置き場所。
+    いずれも初回利用時に作成し、シークレットは TTL 付きでキャッシュする。
+    SECRET_ENV_OVERRIDES の環境変数が設定されていれば Secret Manager を呼ばずにその値を使う (ローカル実行用)。
+    """
+
+    def __init__(self, ttl_seconds=SECRET_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._secrets = {}
+        self._supabase = None
+        self._supabase_credentials = None
+        self._gemini = None
+        self._gemini_api_key = None
+
+    def _cached_secret(self, secret_id):
+        env_name = SECRET_ENV_OVERRIDES.get(secret_id)
+        if env_name and os.environ.get(env_name):
+            return os.environ[env_name]
+        cached = self._secrets.get(secret_id)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl_seconds:
+            return cached[0]
+        return None
+
+    def get_secrets(self, secret_ids):
+        """複数のシークレットを取得する。キャッシュにないものは並列に Secret Manager から取得する"""
+        values = {secret_id: self._cached_secret(secret_id) for secret_id in secret_ids}
+        missing = [secret_id for secret_id, value in values.items() if value is None]
+        if missing:
+            with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                fetched = dict(zip(missing, executor.map(utils.get_secret, missing)))
+            now = time.monotonic()
+            with self._lock:
+                for secret_id, value in fetched.items():
+                    self._secrets[secret_id] = (value, now)
+            values.update(fetched)
+        return values
+
+    def get_secret(self, secret_id):
+        return self.get_secrets([secret_id])[secret_id]
+
+    def prefetch(self):
+        """このリクエストで使うシークレットをまとめて並列に取得しておく"""
+        self.get_secrets([SECRET_URL_ID, SECRET_KEY_ID, GEMINI_API_KEY_SECRET_ID])
+
+    def supabase(self):
+        """Supabase クライアントを返す。シークレットが変わった場合だけ作り直す"""
+        secrets = self.get_secrets([SECRET_URL_ID, SECRET_KEY_ID])
+        credentials = (secrets[SECRET_URL_ID], secrets[SECRET_KEY_ID])
+        with self._lock:
+            if self._supabase is None or self._supabase_credentials != credentials:
+                self._supabase = create_client(*credentials)
+                self._supabase_credentials = credentials
+                log.info("Supabase client initialized")
+            return self._supabase
+
+    def gemini(self):
+        """Gemini クライアントを返す。API キーが変わった場合だけ作り直す"""
+        api_key = self.get_secret(GEMINI_API_KEY_SECRET_ID)
+        with self._lock:
+            if self._gemini is None or self._gemini_api_key != api_key:
+                self._gemini = genai.Client(api_key=api_key)
+                self._gemini_api_key = api_key
+                log.info("Gemini client initialized")
+            return self._gemini
+
+    def override(self, supabase=None, gemini=None):
+        """ローカル検証用に、シークレットを使わずクライアントを差し替える"""
+        with self._lock:
+            # ダミーのシークレットを期限なしでキャッシュし、差し替えたクライアントが作り直されないようにする
+            for secret_id in (SECRET_URL_ID, SECRET_KEY_ID, GEMINI_API_KEY_SECRET_ID):
+                self._secrets[secret_id] = ("override", float("inf"))
+            self._supabase, self._supabase_credentials = supabase, ("override", "override")
+            self._gemini, self._gemini_api_key = gemini, "override"
+
+
+registry = ClientRegistry()
@@ -0,0 +1,81 @@
+from google.genai import types # `types` を直接インポート
+from pydantic import ValidationError
+from gemini_client import generate_content # レート制限付きで Gemini client を呼び出す
+from models import DailyOutputs
+from prompt_encoding import encode_conversation, TRANSCRIPT_FORMAT_NOTE
+from routing import default_route
+from quiz_index import exclusion_note
+import structured_log as log
+from resilience import raise_if_transient
+
+def _is_valid_outputs(text):
+    """検証に通るレスポンスだけをキャッシュに保存する"""
+    try:
+        DailyOutputs.model_validate_json(text)
+        return True
+    except ValidationError:
+        return False
+
+def make_combined_outputs(conversation_json, route=None, exclusions=None):
+    """
+    会話内容を1回だけ送信し、日報・問題・発展的なアドバイスをまとめて生成する (route でモデルと生成設定を指定できる)。
+    exclusions に過去の問題を渡すと、それらと重複しない問題を作るようプロンプトで指示する。
+    レスポンスが DailyOutputs の形式に合わない場合や呼び出しに失敗した場合は None を返す
+    (呼び出し側は従来の3回呼び出しにフォールバックする)。
+    """
+    route = route or default_route("combined")
+    user_id = conversation_json.get("user_id")
+    try:
+        conversation_text = encode_conversation(conversation_json, route.token_budget).text
+
+        system_instruction = (
+            "あなたは経験豊富な学習メンターであり、教育の専門家です。"
+            "提供された会話履歴を分析し、学習者の理解度に合わせた日報・問題・発展的なアドバイスを作成してください。"
+        )
+
+        prompt_contents = (
+            f"{TRANSCRIPT_FORMAT_NOTE}\n\n"
+            f"会話履歴:\n{conversation_text}\n\n"
+            "上記会話履歴に基づいて、以下の3つを作成し、指定のJSON形式で返してください。\n\n"
+            "basic_report:\n"
+            "ユーザーが今日何を学び、どのような点に苦労し、どのような進捗があったかを具体的に指摘し、"
+            "今後の学習に役立つ具体的なアドバイスを、励ますように親しみやすい言葉で書いた本日の学習のまとめ。\n\n"
+            "quizzes:\n"
+            "この会話と basic_report をもとに、ユーザーの学力向上に役立つ問題を数問。"
+            "各問題は question と answer の両方を含めること。"
+            f"{exclusion_note(exclusions)}\n\n"
+            "advanced_report:\n"
+            "以下の見出しごとに、学習内容に関連する発展的な情報を自然な文章形式で書いたもの。\n"
+            "【関連分野と応用例】\n"
+            "【より深い理解のためのトピック】\n"
+            "【実践的な演習と問題】\n"
+            "【日常生活や他の分野との関連】"
+        )
+
+        response = generate_content(
+            model=route.model,
+            contents=prompt_contents,
+            config=types.GenerateContentConfig(
+                system_instruction=system_instruction,
+                response_mime_type='application/json',
+                response_schema=DailyOutputs,
+                **route.generation_settings
+            ),
+            service="combined",
+            validate=_is_valid_outputs
+        )
+
+        try:
+            outputs = DailyOutputs.model_validate_json(response.text)
+        except ValidationError as e:
+            log.warning("Combined response failed validation", user_id=user_id, error=str(e))
+            log.payload("Raw text", response.text, sample_key=user_id, user_id=user_id)
+            return None
+
+        log.debug("make_combined_outputs parsed quizzes", user_id=user_id, num_quizzes=len(outputs.quizzes))
+        return outputs
+
+    except Exception as e:
+        log.error("Error in make_combined_outputs", exc_info=True, user_id=user_id, error=str(e))
+        raise_if_transient(e)
+        return None
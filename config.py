@@ -1,4 +1,124 @@
+import os
+
 PROJECT_ID = "studyfellow"
 SECRET_KEY_ID = "supabase-service-role-key"
 SECRET_URL_ID = "supabase-url"
-GEMINI_API_KEY_SECRET_ID = "gemini-api-key" 
\ No newline at end of file
+GEMINI_API_KEY_SECRET_ID = "gemini-api-key"
+
+# ローカル実行用: これらの環境変数が設定されていれば Secret Manager を使わずにその値を使う
+SECRET_ENV_OVERRIDES = {
+    SECRET_URL_ID: "SUPABASE_URL",
+    SECRET_KEY_ID: "SUPABASE_SERVICE_ROLE_KEY",
+    GEMINI_API_KEY_SECRET_ID: "GEMINI_API_KEY",
+}
+SECRET_CACHE_TTL_SECONDS = int(os.environ.get("SECRET_CACHE_TTL_SECONDS", "3600"))
+
+# 会話履歴の一括取得設定
+ACTIVITY_FETCH_PAGE_SIZE = 1000  # 1リクエストあたりの取得行数 (Supabase の max rows 以下にする)
+ACTIVITY_FETCH_KEY_CHUNK_SIZE = 200  # IN 句に渡す user_id / post_id の最大件数
+
+# ユーザー単位の並列処理設定
+USER_WORKER_CONCURRENCY = int(os.environ.get("USER_WORKER_CONCURRENCY", "8"))
+
+# Gemini API のレート制限 (プロジェクトのクォータに合わせて環境変数で調整する)
+GEMINI_REQUESTS_PER_MINUTE = int(os.environ.get("GEMINI_REQUESTS_PER_MINUTE", "1000"))
+GEMINI_TOKENS_PER_MINUTE = int(os.environ.get("GEMINI_TOKENS_PER_MINUTE", "1000000"))
+GEMINI_OUTPUT_TOKEN_RESERVE = 1024  # リクエスト前に出力分として見込むトークン数
+
+# レポート・アドバイスをストリーミングで生成し、1回の呼び出しにかける時間に上限を設ける
+# (期限を過ぎた場合は途中までの出力を「未完了」として保存する)
+GEMINI_STREAMING = os.environ.get("GEMINI_STREAMING", "false").lower() in ("1", "true", "yes")
+GEMINI_STREAM_DEADLINE_SECONDS = float(os.environ.get("GEMINI_STREAM_DEADLINE_SECONDS", "120"))
+
+# 生成モード: "separate" はレポート・問題・アドバイスを個別に3回呼び出す従来方式、
+# "combined" は1回の構造化出力でまとめて生成する (失敗時はユーザー単位で separate にフォールバック)
+GENERATION_MODE = os.environ.get("GENERATION_MODE", "separate")
+GENERATION_MODES = ("separate", "combined")
+
+# プロンプトに載せる会話履歴の設定
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "30000"))  # 会話履歴部分のトークン上限 (概算)
+PROMPT_RECENT_TURNS_KEPT = 40  # 予算超過時にも優先して残す直近の発言数
+PROMPT_MAX_TURN_CHARS = 2000  # 1発言あたりの最大文字数 (超えた分は切り詰める)
+
+# 会話量に応じたモデル・生成設定の選択 (routing.py)。"size" は会話量で切り替え、"fixed" は常に標準モデルを使う
+ROUTING_POLICY = os.environ.get("ROUTING_POLICY", "size")
+MODEL_LIGHT = os.environ.get("MODEL_LIGHT", "gemini-1.5-flash-8b")  # 会話量が少ない日に使う安価なモデル
+MODEL_STANDARD = os.environ.get("MODEL_STANDARD", "gemini-1.5-flash")
+MODEL_LONG_CONTEXT = os.environ.get("MODEL_LONG_CONTEXT", "gemini-1.5-pro")  # PROMPT_TOKEN_BUDGET に収まらない日に使う
+ROUTING_LIGHT_MAX_TOKENS = int(os.environ.get("ROUTING_LIGHT_MAX_TOKENS", "1500"))  # これ以下の会話量は軽量モデル
+ROUTING_SKIP_INSIGHTS_MAX_TOKENS = int(os.environ.get("ROUTING_SKIP_INSIGHTS_MAX_TOKENS", "300"))  # これ以下は発展的なアドバイスを省略
+ROUTING_LONG_CONTEXT_TOKEN_BUDGET = int(os.environ.get("ROUTING_LONG_CONTEXT_TOKEN_BUDGET", "200000"))
+ROUTING_LIGHT_MAX_OUTPUT_TOKENS = {"report": 1024, "insights": 1024}  # 軽量モデルでの出力トークン上限 (JSONを返すタスクは制限しない)
+
+# 活動量の少ないユーザーの簡易処理 (activity_scoring.py)。スコアが SKIP 以下なら処理せず、TEMPLATE 以下なら
+# Gemini を呼ばずに定型のレポートだけを保存する。0 にするとそれぞれ無効になる
+ACTIVITY_SKIP_MAX_SCORE = float(os.environ.get("ACTIVITY_SKIP_MAX_SCORE", "1.5"))
+ACTIVITY_TEMPLATE_MAX_SCORE = float(os.environ.get("ACTIVITY_TEMPLATE_MAX_SCORE", "4"))
+ACTIVITY_SCORE_CHARS_PER_POINT = 200  # ユーザーの発言の文字数をこの文字数ごとに1点として加算する
+ACTIVITY_SCORE_AI_REPLY_WEIGHT = 0.5  # AIの返答1件あたりの点数 (ユーザーの発言・投稿は1件1点)
+
+# 過去の問題との重複除去 (quiz_index.py)。対象ユーザーの過去の問題を処理順にチャンク単位で読み込む
+QUIZ_DEDUP_ENABLED = os.environ.get("QUIZ_DEDUP_ENABLED", "true").lower() in ("1", "true", "yes")
+QUIZ_HISTORY_FUNCTION = "recent_quiz_questions"  # ユーザーごとに新しい順の問題を上限件数まで返す SQL 関数 (quiz_index.load_quiz_index)
+QUIZ_INDEX_LOOKBACK_DAYS = int(os.environ.get("QUIZ_INDEX_LOOKBACK_DAYS", "90"))  # これより古い問題は読み込まない (0 で無制限)
+QUIZ_INDEX_MAX_PER_USER = int(os.environ.get("QUIZ_INDEX_MAX_PER_USER", "1000"))  # ユーザーごとに保持する新しい順の問題数
+QUIZ_INDEX_MAX_QUESTIONS = int(os.environ.get("QUIZ_INDEX_MAX_QUESTIONS", "100000"))  # 同時に保持する問題数の上限 (1問あたり最大で約800バイト)
+# 1回に読み込むユーザー数。読み込み中のチャンクと処理中のチャンクを合わせて QUIZ_INDEX_MAX_QUESTIONS 件に収める
+QUIZ_INDEX_LOAD_USERS = max(1, QUIZ_INDEX_MAX_QUESTIONS // (2 * QUIZ_INDEX_MAX_PER_USER))
+QUIZ_NEAR_DUPLICATE_SIMILARITY = float(os.environ.get("QUIZ_NEAR_DUPLICATE_SIMILARITY", "0.7"))  # 推定 Jaccard 係数がこれ以上なら重複
+QUIZ_SHINGLE_SIZE = 3  # 正規化した問題文を何文字ずつの n-gram に分けるか
+QUIZ_MINHASH_SIZE = 32  # MinHash (bottom-k) の署名に残す最小ハッシュ値の数
+QUIZ_LSH_KEYS = 8  # 候補の絞り込みに使う、署名の先頭 (最小) 側のハッシュ値の数
+QUIZ_PROMPT_EXCLUSIONS = int(os.environ.get("QUIZ_PROMPT_EXCLUSIONS", "10"))  # プロンプトで避けるよう伝える直近の問題数 (0 で無効)
+QUIZ_PROMPT_EXCLUSION_CHARS = 100  # プロンプトに載せる問題文1件あたりの最大文字数
+
+# Gemini 出力キャッシュの設定 ("none" / "sqlite" / "supabase")
+OUTPUT_CACHE_BACKEND = os.environ.get("OUTPUT_CACHE_BACKEND", "none")
+OUTPUT_CACHE_TTL_SECONDS = int(os.environ.get("OUTPUT_CACHE_TTL_SECONDS", str(2 * 24 * 60 * 60)))
+OUTPUT_CACHE_MAX_ENTRIES = int(os.environ.get("OUTPUT_CACHE_MAX_ENTRIES", "100000"))
+OUTPUT_CACHE_SQLITE_PATH = os.environ.get("OUTPUT_CACHE_SQLITE_PATH", "/tmp/gemini_output_cache.sqlite3")
+OUTPUT_CACHE_TABLE = "gemini_output_cache"
+
+# 日次実行の状況を (user_id, run_date) 単位で記録するテーブル
+RUN_STATUS_TABLE = "daily_task_runs"
+
+# 会話履歴の取得範囲: "rolling" は実行時点から直近24時間、
+# "incremental" はユーザーごとの処理済み位置 (high-water mark) より後の行だけを取得する
+ACTIVITY_WINDOW_MODE = os.environ.get("ACTIVITY_WINDOW_MODE", "rolling")
+ACTIVITY_WINDOW_MODES = ("rolling", "incremental")
+WATERMARK_TABLE = "user_activity_watermarks"  # (user_id, source) ごとの処理済み位置 (created_at, id)
+WATERMARK_INITIAL_LOOKBACK_HOURS = 24  # high-water mark がないユーザーの取得開始位置
+WATERMARK_MAX_LOOKBACK_HOURS = int(os.environ.get("WATERMARK_MAX_LOOKBACK_HOURS", str(7 * 24)))  # これより古い位置は切り詰める
+WATERMARK_SAFETY_LAG_SECONDS = 60  # コミットが遅れた行を取りこぼさないよう、取得範囲の終端を少し手前にする
+BACKFILL_MAX_DAYS = 31  # 1回の backfill 呼び出しで処理する日数の上限
+
+# シャード分割 (coordinator / worker モード) の設定
+SHARD_WORKER_URL = os.environ.get("SHARD_WORKER_URL")  # worker として呼び出す自分自身の関数URL
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "4"))
+SHARD_STRATEGY = os.environ.get("SHARD_STRATEGY", "load")  # "count" または "load" (推定トークン量)
+FUNCTION_TIMEOUT_SECONDS = int(os.environ.get("FUNCTION_TIMEOUT_SECONDS", "1200"))  # デプロイ時の関数のタイムアウト
+# ワーカーの応答を待つ上限。coordinator 自身がタイムアウトする前に 502 / failed_shards のまとめを返せるよう、
+# 関数のタイムアウトより短くする
+SHARD_DISPATCH_TIMEOUT_SECONDS = FUNCTION_TIMEOUT_SECONDS - 120
+
+# 一時的なエラー (429 / 5xx / タイムアウト) の再試行とサーキットブレーカーの設定
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "4"))  # 1回の呼び出しあたりの最大試行回数
+RETRY_BASE_DELAY_SECONDS = 1.0  # 指数バックオフの初回待ち時間 (実際の待ち時間はこれを上限にランダムに決める)
+RETRY_MAX_DELAY_SECONDS = 30.0
+RETRY_AFTER_MAX_SECONDS = 120.0  # Retry-After で指定されても、これより長くは待たない
+GEMINI_RETRY_BUDGET_PER_RUN = int(os.environ.get("GEMINI_RETRY_BUDGET_PER_RUN", "200"))  # 1回の実行での再試行回数の上限
+SUPABASE_RETRY_BUDGET_PER_RUN = int(os.environ.get("SUPABASE_RETRY_BUDGET_PER_RUN", "100"))
+CIRCUIT_WINDOW_SECONDS = 30  # エラー率を計算する期間
+CIRCUIT_MIN_CALLS = 20  # 期間内の呼び出しがこれ未満ならエラー率で遮断しない
+CIRCUIT_FAILURE_RATE = 0.5  # 一時的なエラーの割合がこれを超えたら呼び出しを止める
+CIRCUIT_COOLDOWN_SECONDS = 20  # 遮断してから試験的な呼び出しを再開するまでの時間
+CIRCUIT_MAX_WAIT_SECONDS = 60  # 遮断中の呼び出しが再開を待つ最大時間 (再試行予算が尽きていれば待たずに失敗させる)
+
+# フォルダ・問題・レポートの書き込みをユーザーをまたいでまとめる設定
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", "50"))  # 1回の書き込みでまとめるユーザー数
+WRITE_FLUSH_INTERVAL_SECONDS = float(os.environ.get("WRITE_FLUSH_INTERVAL_SECONDS", "5"))
+
+# ログの設定
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")  # DEBUG にすると会話JSONや生成結果も (抽出して) 出力する
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))  # ペイロードを出力するユーザーの割合
+LOG_PAYLOAD_MAX_CHARS = int(os.environ.get("LOG_PAYLOAD_MAX_CHARS", "2000"))
@@ -0,0 +1,245 @@
+import threading
+import time
+from clients import registry # Gemini client は初回呼び出し時に作成される
+from config import GEMINI_REQUESTS_PER_MINUTE, GEMINI_TOKENS_PER_MINUTE, GEMINI_OUTPUT_TOKEN_RESERVE
+from config import GEMINI_STREAMING, GEMINI_STREAM_DEADLINE_SECONDS
+from metrics import metrics
+import structured_log as log
+from output_cache import cache_key, get_cache
+from prompt_encoding import estimate_tokens
+from rate_limiter import GeminiRateLimiter
+from resilience import gemini_policy
+
+# プロセス内の全ワーカーで共有するレートリミッター
+rate_limiter = GeminiRateLimiter(GEMINI_REQUESTS_PER_MINUTE, GEMINI_TOKENS_PER_MINUTE)
+
+
+class CachedResponse:
+    """キャッシュから復元したレスポンス。text のみを持ち、トークン使用量はない"""
+
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+def _usage_count(response, field):
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, field, None) if usage is not None else None
+
+
+def hit_output_limit(response):
+    """max_output_tokens に達して生成が打ち切られた (finish_reason が MAX_TOKENS) なら True"""
+    candidates = getattr(response, "candidates", None) or []
+    reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+    return getattr(reason, "name", reason) == "MAX_TOKENS"
+
+
+def _lookup_cache(model, contents, config, service):
+    """出力キャッシュのキーとキャッシュ済みの出力 (なければ None) を返す。キャッシュが無効ならキーも None"""
+    cache = get_cache()
+    if cache is None:
+        return None, None
+    prompt_text = contents if isinstance(contents, str) else str(contents)
+    system_instruction = getattr(config, "system_instruction", None) or ""
+    schema = getattr(config, "response_schema", None)
+    key = cache_key(service, model, system_instruction, {"contents": prompt_text, "response_schema": repr(schema)})
+    return key, cache.get(key, service)
+
+
+def _acquire(contents, config, service):
+    """レートリミッターの枠を確保し、見込んだトークン数を返す"""
+    prompt_text = contents if isinstance(contents, str) else str(contents)
+    system_instruction = getattr(config, "system_instruction", None) or ""
+    estimated = estimate_tokens(prompt_text) + estimate_tokens(str(system_instruction)) + GEMINI_OUTPUT_TOKEN_RESERVE
+
+    waited = rate_limiter.acquire(estimated)
+    if waited > 0:
+        log.debug("Gemini rate limiter waited", service=service, waited_seconds=round(waited, 2))
+        metrics.observe("gemini.rate_limit_wait", waited)
+    return estimated
+
+
+def _record(response, model, service, estimated, elapsed):
+    prompt_tokens = _usage_count(response, "prompt_token_count") or 0
+    output_tokens = _usage_count(response, "candidates_token_count") or 0
+    metrics.incr(f"gemini.{service}.calls")
+    metrics.incr(f"gemini.{service}.latency_seconds", elapsed)
+    metrics.observe(f"gemini.{service}", elapsed)
+    metrics.incr(f"gemini.{service}.prompt_tokens", prompt_tokens)
+    metrics.incr(f"gemini.{service}.output_tokens", output_tokens)
+    # ルーティングの効果を確認できるよう、モデルごとにも集計する
+    metrics.incr(f"model.{model}.calls")
+    metrics.incr(f"model.{model}.prompt_tokens", prompt_tokens)
+    metrics.incr(f"model.{model}.output_tokens", output_tokens)
+    rate_limiter.reconcile(estimated, _usage_count(response, "total_token_count"))
+
+
+def generate_content(model, contents, config, service, validate=None):
+    """
+    レート制限を守りながら Gemini の generate_content を呼び出す。
+    service ごとに呼び出し回数・トークン数・レイテンシを metrics に記録する。
+    出力キャッシュが有効な場合は同じ入力に対する出力を再利用し、
+    validate が指定されていればそれを通過した出力だけを保存する (出力トークンの上限で打ち切られた出力は保存しない)。
+    """
+    key, cached_text = _lookup_cache(model, contents, config, service)
+    if cached_text is not None:
+        return CachedResponse(cached_text)
+
+    def attempt():
+        estimated = _acquire(contents, config, service)
+        started = time.perf_counter()
+        try:
+            response = registry.gemini().models.generate_content(model=model, contents=contents, config=config)
+        except Exception:
+            # 失敗した呼び出しはトークンを消費しないため、見込んだ分をレートリミッターに戻す
+            rate_limiter.reconcile(estimated, 0)
+            metrics.incr(f"gemini.{service}.errors")
+            raise
+        _record(response, model, service, estimated, time.perf_counter() - started)
+        return response
+
+    # 429 / 5xx などの一時的なエラーはバックオフして再試行する (リクエストごとにレート制限の枠を取り直す)
+    response = gemini_policy.call(attempt, operation=service)
+
+    if hit_output_limit(response):
+        metrics.incr(f"gemini.{service}.truncated")
+    elif key is not None and response.text and (validate is None or validate(response.text)):
+        get_cache().set(key, service, response.text)
+    return response
+
+
+class StreamedResponse:
+    """
+    ストリーミングで受け取った断片を連結したレスポンス。
+    complete が False の場合は、期限までに生成が終わらなかった (または途中で失敗した) 途中までの出力。
+    truncated が True の場合は、max_output_tokens に達して打ち切られた出力。
+    """
+
+    def __init__(self, text, complete, usage_metadata=None, truncated=False):
+        self.text = text
+        self.complete = complete
+        self.usage_metadata = usage_metadata
+        self.truncated = truncated
+
+
+class GenerationDeadlineExceeded(Exception):
+    """ストリーミング生成が期限までに1文字も出力しなかった (期限の問題なので再試行しない)"""
+
+
+def _stream_once(model, contents, config, service, timeout_seconds):
+    """
+    generate_content_stream を1回呼び出し、timeout_seconds 秒で打ち切って StreamedResponse を返す。
+    何も受信できないまま失敗・時間切れになった場合は例外を送出する。
+    """
+    estimated = _acquire(contents, config, service)
+    started = time.perf_counter()
+    try:
+        stream = registry.gemini().models.generate_content_stream(model=model, contents=contents, config=config)
+    except Exception:
+        rate_limiter.reconcile(estimated, 0)
+        metrics.incr(f"gemini.{service}.errors")
+        raise
+    lock = threading.Lock()
+    stop = threading.Event()
+    chunks = []
+    state = {"usage_metadata": None, "error": None, "truncated": False}
+
+    def consume():
+        try:
+            for chunk in stream:
+                with lock:
+                    if chunk.text:
+                        chunks.append(chunk.text)
+                    if getattr(chunk, "usage_metadata", None) is not None:
+                        state["usage_metadata"] = chunk.usage_metadata
+                    if hit_output_limit(chunk):
+                        state["truncated"] = True
+                if stop.is_set():
+                    break
+        except Exception as e:
+            state["error"] = e
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+
+    receiver = threading.Thread(target=consume, name=f"gemini-stream-{service}", daemon=True)
+    receiver.start()
+    receiver.join(timeout_seconds)
+    timed_out = receiver.is_alive()
+    if timed_out:
+        stop.set()
+    with lock:
+        response = StreamedResponse("".join(chunks), complete=not timed_out and state["error"] is None,
+                                    usage_metadata=state["usage_metadata"], truncated=state["truncated"])
+        error = state["error"]
+
+    if not response.text and error is not None:
+        rate_limiter.reconcile(estimated, 0)
+        metrics.incr(f"gemini.{service}.errors")
+        raise error
+    _record(response, model, service, estimated, time.perf_counter() - started)
+    if not response.text and timed_out:
+        raise GenerationDeadlineExceeded(f"Gemini stream for {service} produced no output in time")
+    if response.truncated:
+        metrics.incr(f"gemini.{service}.truncated")
+    if not response.complete:
+        metrics.incr(f"gemini.{service}.incomplete")
+        log.warning("Gemini stream ended before completion", service=service, timed_out=timed_out,
+                    error=str(error) if error is not None else None, received_chars=len(response.text))
+    return response
+
+
+def generate_content_stream(model, contents, config, service, deadline_seconds=GEMINI_STREAM_DEADLINE_SECONDS):
+    """
+    generate_content_stream で生成し、deadline_seconds 秒で打ち切って StreamedResponse を返す。
+    受信は専用のスレッドで行い、期限を過ぎたら受信済みの断片だけを返す (スレッドは次の断片で受信をやめる)。
+    何も受信できないまま一時的なエラーになった場合は、期限の残り時間の範囲で再試行する。
+    キャッシュには最後まで (出力トークンの上限に達せずに) 生成できた出力だけを保存する。
+    """
+    key, cached_text = _lookup_cache(model, contents, config, service)
+    if cached_text is not None:
+        return StreamedResponse(cached_text, complete=True)
+
+    deadline = time.monotonic() + deadline_seconds
+
+    def attempt():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise GenerationDeadlineExceeded(f"Gemini stream for {service} ran out of time before retrying")
+        return _stream_once(model, contents, config, service, remaining)
+
+    response = gemini_policy.call(attempt, operation=service)
+    if response.complete and not response.truncated and key is not None and response.text:
+        get_cache().set(key, service, response.text)
+    return response
+
+
+INCOMPLETE_NOTICE = "\n\n(生成が時間内に完了しなかったため、途中までの内容です)"
+TRUNCATED_NOTICE = "\n\n(出力の長さの上限に達したため、途中までの内容です)"
+
+
+class IncompleteText(str):
+    """
+    最後まで生成できなかった途中までのテキスト。
+    末尾に INCOMPLETE_NOTICE (期限切れ) か TRUNCATED_NOTICE (出力トークンの上限) が付いている
+    """
+
+
+def generate_text(model, contents, config, service):
+    """
+    テキストを生成して返す。GEMINI_STREAMING が有効ならストリーミングで生成する。
+    期限で打ち切られた場合は INCOMPLETE_NOTICE を、max_output_tokens で打ち切られた場合は
+    TRUNCATED_NOTICE を付けた IncompleteText を返す。
+    """
+    if not GEMINI_STREAMING:
+        response = generate_content(model=model, contents=contents, config=config, service=service)
+        if hit_output_limit(response):
+            return IncompleteText(response.text + TRUNCATED_NOTICE)
+        return response.text
+    response = generate_content_stream(model=model, contents=contents, config=config, service=service)
+    if not response.complete:
+        return IncompleteText(response.text + INCOMPLETE_NOTICE)
+    if response.truncated:
+        return IncompleteText(response.text + TRUNCATED_NOTICE)
+    return response.text
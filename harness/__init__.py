@@ -0,0 +1 @@
+"""スタブの Supabase・Gemini を使って execute_daily_tasks をローカルで動かすための道具"""
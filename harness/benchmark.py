@@ -0,0 +1,136 @@
+"""
+スタブの Supabase・Gemini に対して execute_daily_tasks (single モード) を実行し、スループットを計測する。
+スケーリングの変更前後で同じ引数を使って比較する。
+
+    python -m harness.benchmark --users 1000 --gemini-latency 0.2 --supabase-latency 0.01
+    python -m harness.benchmark --users 1000 --gemini-rpm 600 --output before.json
+
+出力する内容:
+  - 実行時間とユーザー数/秒 (活動のあるユーザー数 ÷ 実行時間)
+  - tracemalloc で計測したピークメモリ
+  - Supabase のテーブル・操作ごとの往復回数、Gemini の呼び出し回数とレート制限で拒否された回数
+  - 成功・失敗したユーザー数と metrics のレイテンシ分布 (p50/p95)
+  - 会話量による区分 (light / standard / long_context) ごとのユーザー数
+  - 活動量が少なく Gemini を呼ばずに処理したユーザー数と、省いた呼び出し回数
+  - 過去の問題の索引の件数と、重複として除いた問題数
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+
+def run_benchmark(args):
+    """新しいスタブ環境で execute_daily_tasks を1回実行し、計測結果の辞書を返す"""
+    import flask
+    from harness.stubs import StubGemini, StubSupabase, install_stubs
+    from harness.synthetic import generate_tables
+
+    tables = generate_tables(args.users, active_ratio=args.active_ratio, messages_per_user=args.messages_per_user,
+                             posts_per_user=args.posts_per_user, quiz_history_per_user=args.quiz_history_per_user,
+                             seed=args.seed)
+    active_user_ids = {row["user_id"] for row in tables["messages"]} | {row["user_id"] for row in tables["posts"]}
+    supabase_stub = StubSupabase(tables, latency_seconds=args.supabase_latency,
+                                 max_concurrency=args.supabase_max_concurrency)
+    gemini_stub = StubGemini(latency_seconds=args.gemini_latency, requests_per_minute=args.gemini_rpm,
+                             tokens_per_minute=args.gemini_tpm, error_rate=args.gemini_error_rate, seed=args.seed)
+    main = install_stubs(supabase_stub, gemini_stub)
+    from metrics import metrics
+    app = flask.Flask(__name__)
+
+    body = {"generation_mode": args.generation_mode}
+    tracemalloc.start()
+    started = time.perf_counter()
+    with app.test_request_context(json=body):
+        message, status = main.execute_daily_tasks(flask.request)
+    elapsed = time.perf_counter() - started
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if status != 200:
+        raise SystemExit(f"execute_daily_tasks returned {status}: {message}")
+
+    statuses = Counter(row["status"] for row in supabase_stub.rows("daily_task_runs"))
+    return {
+        "params": vars(args),
+        "users": args.users,
+        "active_users": len(active_user_ids),
+        "succeeded_users": statuses.get("succeeded", 0),
+        "failed_users": statuses.get("failed", 0),
+        "wall_seconds": round(elapsed, 3),
+        "users_per_second": round(len(active_user_ids) / elapsed, 2) if elapsed > 0 else None,
+        "peak_memory_mb": round(peak_bytes / 1024 / 1024, 2),
+        "supabase_round_trips": sum(supabase_stub.round_trips.values()),
+        "supabase_round_trips_by_op": dict(sorted(supabase_stub.round_trips.items())),
+        "gemini_calls": sum(gemini_stub.calls.values()),
+        "gemini_rate_limited": gemini_stub.rate_limited,
+        "gemini_errors": gemini_stub.errors,
+        "retries": {name: int(value) for name, value in metrics.snapshot().items()
+                    if name.startswith(("retry.", "circuit."))},
+        "routing": main.summarize_routing(metrics.snapshot()),
+        "fast_path": main.summarize_fast_path(metrics.snapshot()),
+        "quiz_dedup": {name[len("quiz_index."):]: int(value) for name, value in metrics.snapshot().items()
+                       if name.startswith("quiz_index.")},
+        "latency_seconds": metrics.latency_summary(),
+    }
+
+
+def print_report(result):
+    print("=== benchmark ===")
+    print(f"users: {result['users']}, active: {result['active_users']}, "
+          f"succeeded: {result['succeeded_users']}, failed: {result['failed_users']}")
+    print(f"wall time: {result['wall_seconds']:.2f}s, throughput: {result['users_per_second']} users/s, "
+          f"peak memory: {result['peak_memory_mb']} MB")
+    print(f"supabase round trips: {result['supabase_round_trips']}")
+    for op, count in result["supabase_round_trips_by_op"].items():
+        print(f"  {op}: {count}")
+    print(f"gemini calls: {result['gemini_calls']} (rate limited: {result['gemini_rate_limited']}, "
+          f"transient errors: {result['gemini_errors']})")
+    for name, count in sorted(result["retries"].items()):
+        print(f"  {name}: {count}")
+    print(f"routing tiers: {result['routing']['tiers']} (insights skipped: {result['routing']['insights_skipped']})")
+    print(f"low activity: {result['fast_path']['skipped_users']} skipped, "
+          f"{result['fast_path']['templated_users']} templated, "
+          f"{result['fast_path']['avoided_gemini_calls']} gemini calls avoided")
+    print(f"quiz dedup: {result['quiz_dedup']}")
+    for name, summary in result["latency_seconds"].items():
+        print(f"  {name}: n={summary['count']} p50={summary['p50']}s p95={summary['p95']}s max={summary['max']}s")
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--active-ratio", type=float, default=0.6)
+    parser.add_argument("--messages-per-user", type=int, default=12)
+    parser.add_argument("--posts-per-user", type=int, default=2)
+    parser.add_argument("--quiz-history-per-user", type=int, default=0, help="ユーザーごとの過去の問題数")
+    parser.add_argument("--generation-mode", choices=("separate", "combined"), default="separate")
+    parser.add_argument("--gemini-latency", type=float, default=0.05)
+    parser.add_argument("--gemini-rpm", type=int, default=None, help="スタブ Gemini の分あたりリクエスト上限")
+    parser.add_argument("--gemini-tpm", type=int, default=None, help="スタブ Gemini の分あたりトークン上限")
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0, help="スタブ Gemini が一時的なエラーを返す確率")
+    parser.add_argument("--supabase-latency", type=float, default=0.005)
+    parser.add_argument("--supabase-max-concurrency", type=int, default=None)
+    parser.add_argument("--worker-concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="計測結果を JSON で書き出すパス")
+    args = parser.parse_args(argv)
+
+    # config は import 時に環境変数を読むため、main を import する前に設定する
+    os.environ.setdefault("USER_WORKER_CONCURRENCY", str(args.worker_concurrency))
+    os.environ.setdefault("GEMINI_REQUESTS_PER_MINUTE", str(args.gemini_rpm or 1_000_000))
+    os.environ.setdefault("GEMINI_TOKENS_PER_MINUTE", str(args.gemini_tpm or 1_000_000_000))
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    result = run_benchmark(args)
+    print_report(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,116 @@
+"""
+coordinator / worker モードをスタブの Supabase・Gemini に対してローカルで検証する。
+worker はスレッドとして起動し、coordinator からの HTTP 呼び出しの代わりに run_daily_tasks を直接呼ぶ
+(execute_daily_tasks は呼び出しのたびにプロセス共有の metrics と再試行予算を戻すため、並列のシャードを壊してしまう)。
+metrics はプロセス内の全シャードで共有されるため、各シャードの Run summary の件数・レイテンシは全シャードの合計になる。
+
+    python -m harness.shard_check --users 300 --shards 4 --gemini-latency 0.05
+
+確認する内容:
+  - シャードが対象ユーザーを重複なく漏れなく覆っていること
+  - 活動のあるユーザーがそれぞれちょうど1回処理されたこと (フォルダ・実行状況が1件ずつ。活動量による省略は無効にする)
+  - シャード数1の場合と比べた実行時間
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+
+
+def _thread_dispatcher(main, supabase_stub):
+    from config import GENERATION_MODE
+
+    cache = main.configure_cache(supabase_stub)
+
+    def dispatch(body):
+        return 200, main.run_daily_tasks(supabase_stub, body, body.get("generation_mode", GENERATION_MODE), cache)
+
+    return dispatch
+
+
+def run_coordinated(args, shard_count):
+    """新しいスタブ環境で coordinator を1回実行し、(経過秒, スタブSupabase, coordinator の結果) を返す"""
+    from harness.stubs import StubGemini, StubSupabase, install_stubs
+    from harness.synthetic import generate_tables
+
+    supabase_stub = StubSupabase(generate_tables(args.users, seed=args.seed), latency_seconds=args.supabase_latency)
+    gemini_stub = StubGemini(latency_seconds=args.gemini_latency)
+    main = install_stubs(supabase_stub, gemini_stub)
+    # execute_daily_tasks の代わりに、実行全体の開始時に1度だけ集計と再試行予算を戻す
+    main.metrics.reset()
+    main.reset_retry_budgets()
+
+    started = time.perf_counter()
+    summary, status = main.coordinate(
+        supabase_stub,
+        {"shard_count": shard_count, "shard_strategy": args.strategy},
+        _thread_dispatcher(main, supabase_stub),
+    )
+    elapsed = time.perf_counter() - started
+    if status != 200:
+        raise SystemExit(f"coordinator returned {status}: {summary}")
+    return elapsed, supabase_stub, summary
+
+
+def verify(supabase_stub, summary):
+    """シャードの網羅性と、ユーザーごとの処理回数を確認する。問題があればメッセージのリストを返す"""
+    problems = []
+    shard_user_ids = [u for shard in summary["shards"] for u in shard["response"]["processed_user_ids"]]
+    duplicated = [u for u, n in Counter(shard_user_ids).items() if n > 1]
+    if duplicated:
+        problems.append(f"{len(duplicated)} users were processed by more than one shard")
+
+    active_user_ids = {row["user_id"] for row in supabase_stub.rows("messages")} | \
+                      {row["user_id"] for row in supabase_stub.rows("posts")}
+    missing = active_user_ids - set(shard_user_ids)
+    if missing:
+        problems.append(f"{len(missing)} active users were not assigned to any shard")
+
+    folders = Counter(row["user_id"] for row in supabase_stub.rows("user_task_folders"))
+    if set(folders) != active_user_ids or any(n != 1 for n in folders.values()):
+        problems.append("user_task_folders does not contain exactly one folder per active user")
+    runs = [row for row in supabase_stub.rows("daily_task_runs") if row["status"] == "succeeded"]
+    if Counter(row["user_id"] for row in runs) != Counter({u: 1 for u in active_user_ids}):
+        problems.append("daily_task_runs does not record exactly one success per active user")
+    return problems
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--strategy", choices=("load", "count"), default="load")
+    parser.add_argument("--gemini-latency", type=float, default=0.05)
+    parser.add_argument("--supabase-latency", type=float, default=0.005)
+    parser.add_argument("--worker-concurrency", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # config は import 時に環境変数を読むため、main を import する前に設定する
+    os.environ.setdefault("USER_WORKER_CONCURRENCY", str(args.worker_concurrency))
+    os.environ.setdefault("GEMINI_REQUESTS_PER_MINUTE", "1000000")
+    os.environ.setdefault("GEMINI_TOKENS_PER_MINUTE", "1000000000")
+    # 活動量の少ないユーザーを省くとフォルダが作られず「ちょうど1回」を確認できないため、省かずに処理させる
+    os.environ.setdefault("ACTIVITY_SKIP_MAX_SCORE", "0")
+
+    baseline_seconds, _, _ = run_coordinated(args, 1)
+    sharded_seconds, supabase_stub, summary = run_coordinated(args, args.shards)
+    problems = verify(supabase_stub, summary)
+
+    print("=== shard check ===")
+    print(f"users: {args.users}, active users assigned: {summary['num_users']}, shards: {summary['num_shards']}")
+    for shard in summary["shards"]:
+        print(f"  shard {shard['shard']}: {len(shard['response']['processed_user_ids'])} users")
+    print(f"1 shard: {baseline_seconds:.2f}s, {args.shards} shards: {sharded_seconds:.2f}s "
+          f"(speedup x{baseline_seconds / sharded_seconds:.2f})")
+    if problems:
+        for problem in problems:
+            print(f"NG: {problem}")
+        return 1
+    print("OK: every active user was processed exactly once")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,346 @@
+import itertools
+import json
+import random
+import threading
+import time
+import typing
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+
+# スタブの問題文。入力ごとに異なる組み合わせを返し、同じ入力には同じ問題を返す
+STUB_QUESTIONS = [
+    "二次関数 y = x^2 - {n}x の頂点の座標を求めなさい。",
+    "平方完成とは何か、例を挙げて説明してください。",
+    "判別式を使って二次方程式の解の個数を調べる方法を説明してください。",
+    "英単語 'consider' を使った例文を作ってください。",
+    "光合成で生成される物質を2つ答えてください。",
+    "三角形の内角の和が180度になる理由を説明してください。",
+    "{n} を素因数分解してください。",
+    "江戸幕府が開かれた年と、開いた人物を答えてください。",
+]
+
+
+class StubRateLimitError(Exception):
+    """スタブの Gemini が分あたりの上限を超えたときに送出する (実サービスの 429 に相当)"""
+
+    code = 429
+
+
+class StubServerError(Exception):
+    """スタブの Gemini が error_rate の確率で送出する一時的なエラー (実サービスの 503 に相当)"""
+
+    code = 503
+
+
+class _SlidingWindow:
+    """直近 window_seconds 秒の使用量を数え、上限を超える要求を拒否する"""
+
+    def __init__(self, limit, window_seconds=60.0):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self._events = deque()
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, amount=1):
+        now = time.monotonic()
+        with self._lock:
+            while self._events and now - self._events[0][0] >= self.window_seconds:
+                self._used -= self._events.popleft()[1]
+            if self._used + amount > self.limit:
+                return False
+            self._events.append((now, amount))
+            self._used += amount
+            return True
+
+
+class StubResult:
+    def __init__(self, data):
+        self.data = data
+
+
+class _Query:
+    """postgrest のクエリビルダーのうち、このリポジトリで使う操作だけを再現する"""
+
+    def __init__(self, db, table, op="select", rows=None, on_conflict=None):
+        self.db = db
+        self.table = table
+        self.op = op
+        self.rows = rows
+        self.on_conflict = on_conflict
+        self.columns = None
+        self.filters = []
+        self.orders = []
+        self.window = None
+
+    def select(self, columns='*'):
+        if columns.strip() != '*':
+            self.columns = [c.strip() for c in columns.split(',')]
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column, values):
+        values = set(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def gte(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] >= value)
+        return self
+
+    def gt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] > value)
+        return self
+
+    def lte(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] <= value)
+        return self
+
+    def lt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] < value)
+        return self
+
+    def order(self, column, desc=False):
+        self.orders.append((column, desc))
+        return self
+
+    def range(self, start, end):
+        self.window = (start, end)
+        return self
+
+    def limit(self, count):
+        self.window = (0, count - 1)
+        return self
+
+    def insert(self, rows):
+        return _Query(self.db, self.table, "insert", rows)
+
+    def upsert(self, rows, on_conflict=None, **kwargs):
+        return _Query(self.db, self.table, "upsert", rows, on_conflict)
+
+    def delete(self):
+        return _Query(self.db, self.table, "delete")
+
+    def execute(self):
+        return self.db.execute(self)
+
+
+def _recent_quiz_questions(tables, params):
+    """quiz_index.load_quiz_index が前提とする SQL 関数 recent_quiz_questions を再現する"""
+    user_ids = set(params["p_user_ids"])
+    excluded = set(params["p_exclude_folder_ids"])
+    since = datetime.fromisoformat(params["p_since"]) if params["p_since"] is not None else None
+    by_user = {}
+    for row in tables.get("user_tasks", []):
+        if row["user_id"] not in user_ids or row.get("task_folder_id") in excluded:
+            continue
+        if since is not None and datetime.fromisoformat(row["created_at"]) < since:
+            continue
+        by_user.setdefault(row["user_id"], []).append(row)
+    result = []
+    for rows in by_user.values():
+        rows.sort(key=lambda row: (datetime.fromisoformat(row["created_at"]), row["id"]), reverse=True)
+        result.extend({"user_id": row["user_id"], "question": row["question"], "created_at": row["created_at"],
+                       "id": row["id"]} for row in rows[:params["p_per_user_limit"]])
+    return result
+
+
+# rpc で呼び出せる SQL 関数のスタブ
+RPC_FUNCTIONS = {"recent_quiz_questions": _recent_quiz_questions}
+
+
+class StubSupabase:
+    """スレッドセーフなインメモリの Supabase クライアント。テーブル・操作ごとの往復回数を数える"""
+
+    def __init__(self, tables=None, latency_seconds=0.0, max_concurrency=None):
+        self.tables = {name: [dict(row) for row in rows] for name, rows in (tables or {}).items()}
+        self.latency_seconds = latency_seconds
+        # max_concurrency を指定すると、同時に処理できるリクエスト数を制限する (コネクションプールの上限を模す)
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self.round_trips = Counter()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1_000_000)
+
+    def table(self, name):
+        return _Query(self, name)
+
+    def rpc(self, name, params):
+        return _Query(self, name, "rpc", params)
+
+    def rows(self, table):
+        with self._lock:
+            return [dict(row) for row in self.tables.get(table, [])]
+
+    def execute(self, query):
+        if self._slots is not None:
+            with self._slots:
+                return self._execute(query)
+        return self._execute(query)
+
+    def _execute(self, query):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        with self._lock:
+            self.round_trips[f"{query.table}.{query.op}"] += 1
+            if query.op == "rpc":
+                return StubResult(self._select(RPC_FUNCTIONS[query.table](self.tables, query.rows), query))
+            table = self.tables.setdefault(query.table, [])
+            if query.op == "select":
+                return StubResult(self._select(table, query))
+            if query.op == "delete":
+                kept = [row for row in table if not all(f(row) for f in query.filters)]
+                deleted = [row for row in table if all(f(row) for f in query.filters)]
+                self.tables[query.table] = kept
+                return StubResult(deleted)
+            return StubResult(self._write(table, query))
+
+    def _select(self, table, query):
+        rows = [row for row in table if all(f(row) for f in query.filters)]
+        for column, desc in reversed(query.orders):
+            rows.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+        if query.window is not None:
+            rows = rows[query.window[0]:query.window[1] + 1]
+        if query.columns is not None:
+            rows = [{c: row.get(c) for c in query.columns} for row in rows]
+        return [dict(row) for row in rows]
+
+    def _write(self, table, query):
+        rows = query.rows if isinstance(query.rows, list) else [query.rows]
+        keys = query.on_conflict.split(',') if query.op == "upsert" and query.on_conflict else None
+        written = []
+        for row in rows:
+            row = dict(row)
+            existing = None
+            if keys:
+                existing = next((r for r in table if all(r.get(k) == row.get(k) for k in keys)), None)
+            if existing is not None:
+                existing.update(row)
+                written.append(dict(existing))
+            else:
+                row.setdefault("id", next(self._ids))
+                # Supabase の created_at 列の既定値 (now()) を再現する
+                row.setdefault("created_at", datetime.now(timezone.utc).isoformat())
+                table.append(row)
+                written.append(dict(row))
+        return written
+
+
+class StubUsage:
+    def __init__(self, prompt_tokens, output_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class StubCandidate:
+    def __init__(self, finish_reason):
+        self.finish_reason = finish_reason
+
+
+class StubResponse:
+    def __init__(self, text, prompt_tokens, max_output_tokens=None):
+        # max_output_tokens を超える出力は打ち切り、finish_reason を MAX_TOKENS にする
+        truncated = max_output_tokens is not None and len(text) // 2 > max_output_tokens
+        self.text = text[:max_output_tokens * 2] if truncated else text
+        self.usage_metadata = StubUsage(prompt_tokens, max(1, len(self.text) // 2))
+        self.candidates = [StubCandidate("MAX_TOKENS" if truncated else "STOP")]
+
+
+class _StubModels:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def generate_content(self, model, contents, config):
+        return self.owner.generate(model, contents, config)
+
+    def generate_content_stream(self, model, contents, config):
+        return self.owner.generate_stream(model, contents, config)
+
+
+class StubChunk:
+    def __init__(self, text, usage_metadata=None, candidates=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+        self.candidates = candidates
+
+
+class StubGemini:
+    """google.genai.Client の代わりに使うスタブ。response_schema に合わせた出力を返す"""
+
+    def __init__(self, latency_seconds=0.0, requests_per_minute=None, tokens_per_minute=None, error_rate=0.0, seed=0):
+        self.latency_seconds = latency_seconds
+        self.models = _StubModels(self)
+        self.calls = Counter()
+        self.rate_limited = 0
+        self.error_rate = error_rate
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._requests = _SlidingWindow(requests_per_minute) if requests_per_minute else None
+        self._tokens = _SlidingWindow(tokens_per_minute) if tokens_per_minute else None
+        self._lock = threading.Lock()
+
+    def generate(self, model, contents, config):
+        self._check_quota(contents)
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        with self._lock:
+            self.calls[model] += 1
+        text = self._output_for(getattr(config, "response_schema", None), str(contents))
+        return StubResponse(text, max(1, len(str(contents)) // 2), getattr(config, "max_output_tokens", None))
+
+    def generate_stream(self, model, contents, config, num_chunks=4):
+        """latency_seconds を num_chunks 個の断片に分けて返す。使用量は最後の断片に付ける"""
+        self._check_quota(contents)
+        with self._lock:
+            self.calls[model] += 1
+        response = StubResponse(self._output_for(getattr(config, "response_schema", None), str(contents)),
+                                max(1, len(str(contents)) // 2), getattr(config, "max_output_tokens", None))
+        size = -(-len(response.text) // num_chunks)
+        for i in range(num_chunks):
+            if self.latency_seconds:
+                time.sleep(self.latency_seconds / num_chunks)
+            last = i == num_chunks - 1
+            yield StubChunk(response.text[i * size:(i + 1) * size], response.usage_metadata if last else None,
+                            response.candidates if last else None)
+
+    def _check_quota(self, contents):
+        prompt_tokens = max(1, len(str(contents)) // 2)
+        if (self._requests is not None and not self._requests.try_acquire()) or \
+                (self._tokens is not None and not self._tokens.try_acquire(prompt_tokens)):
+            with self._lock:
+                self.rate_limited += 1
+            raise StubRateLimitError("429 RESOURCE_EXHAUSTED: stub quota exceeded")
+        with self._lock:
+            failed = self.error_rate and self._random.random() < self.error_rate
+            self.errors += bool(failed)
+        if failed:
+            raise StubServerError("503 UNAVAILABLE: stub transient error")
+
+    @staticmethod
+    def _output_for(schema, contents):
+        digest = abs(hash(contents)) % 10_000
+        quizzes = [
+            {"question": STUB_QUESTIONS[(digest + i) % len(STUB_QUESTIONS)].format(n=digest % 97), "answer": f"解答{digest}-{i}"}
+            for i in range(3)
+        ]
+        if schema is None:
+            return f"スタブの生成テキスト ({digest})"
+        if typing.get_origin(schema) is list:
+            return json.dumps(quizzes, ensure_ascii=False)
+        return json.dumps({
+            "basic_report": f"スタブの日報 ({digest})",
+            "quizzes": quizzes,
+            "advanced_report": f"スタブのアドバイス ({digest})",
+        }, ensure_ascii=False)
+
+
+def install_stubs(supabase_stub, gemini_stub):
+    """クライアントレジストリを Supabase・Gemini のスタブに差し替えたうえで main を import して返す"""
+    import main
+    from clients import registry
+    registry.override(supabase=supabase_stub, gemini=gemini_stub)
+    return main
@@ -0,0 +1,58 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+JST = timezone(timedelta(hours=9), 'JST')
+
+
+def generate_tables(num_users, active_ratio=0.6, messages_per_user=12, posts_per_user=2,
+                    ai_replies_per_post=2, quiz_history_per_user=0, now=None, seed=0):
+    """
+    users / messages / posts / post_messages_to_ai と、過去の問題 (user_tasks) の合成データを作る。
+    活動のあるユーザーの会話量はばらつかせ、シャードの負荷分散が効くようにする。
+    """
+    rng = random.Random(seed)
+    now = now or datetime.now(JST)
+    tables = {"users": [], "messages": [], "posts": [], "post_messages_to_ai": [], "user_tasks": []}
+    next_id = 1
+
+    def timestamp():
+        return (now - timedelta(minutes=rng.randint(1, 23 * 60))).isoformat()
+
+    for u in range(num_users):
+        user_id = f"user-{u:06d}"
+        tables["users"].append({"user_id": user_id})
+        for i in range(quiz_history_per_user):
+            # 過去の問題は数十日分に散らし、言い回しだけが違う問題も混ぜる
+            tables["user_tasks"].append({
+                "id": next_id, "user_id": user_id, "status": "done",
+                "question": f"第{i}問: {rng.randint(1, 500)} 以下の素数をすべて挙げ、その個数を答えてください。",
+                "answer": "省略",
+                "created_at": (now - timedelta(days=rng.randint(1, 60), minutes=i)).isoformat(),
+            })
+            next_id += 1
+        if rng.random() >= active_ratio:
+            continue
+        # 会話量は指数分布でばらつかせる (少数のヘビーユーザーと多数のライトユーザー)
+        num_messages = max(1, int(rng.expovariate(1 / messages_per_user)))
+        for i in range(num_messages):
+            tables["messages"].append({
+                "id": next_id, "user_id": user_id, "room_id": f"room-{u}-{i % 3}",
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": "二次関数の最大値の求め方について質問です。" * rng.randint(1, 6),
+                "created_at": timestamp(),
+            })
+            next_id += 1
+        for _ in range(rng.randint(0, posts_per_user * 2)):
+            post_id = next_id
+            next_id += 1
+            tables["posts"].append({
+                "id": post_id, "user_id": user_id, "comment": "この問題の解き方が分かりません。",
+                "created_at": timestamp(),
+            })
+            for _ in range(rng.randint(0, ai_replies_per_post)):
+                tables["post_messages_to_ai"].append({
+                    "id": next_id, "post_id": post_id, "role": "assistant",
+                    "content": "まず平方完成をしてみましょう。", "created_at": timestamp(),
+                })
+                next_id += 1
+    return tables
@@ -1,16 +1,22 @@
-import json
-from utils import client
+from gemini_client import generate_text # レート制限付きで Gemini client を呼び出す (設定によりストリーミング)
+from prompt_encoding import encode_conversation, TRANSCRIPT_FORMAT_NOTE
 from google.genai import types
+import structured_log as log
+from resilience import raise_if_transient
+from routing import default_route
 
-def generate_learning_insights(conversation_json):
+# 会話量が少なくアドバイスの生成を省略した日に保存する文面
+INSIGHTS_SKIPPED_TEXT = "本日は学習の記録が少なかったため、発展的な学習アドバイスは省略しました。"
+
+def generate_learning_insights(conversation_json, route=None):
     """
     ユーザーの会話履歴を分析し、学習内容に関する発展的な情報やアドバイスを生成する
+    (route でモデルと生成設定を指定できる)
     """
+    route = route or default_route("insights")
     try:
-        print("--- generate_learning_insights ---")
-        
-        # 会話履歴をJSON文字列に変換
-        conversation_json_str = json.dumps(conversation_json, ensure_ascii=False, indent=2)
+        # 会話履歴をコンパクトなトランスクリプト形式に変換
+        conversation_text = encode_conversation(conversation_json, route.token_budget).text
 
         system_instruction = (
             "あなたは教育の専門家です。"
@@ -23,8 +29,9 @@ def generate_learning_insights(conversation_json):
         )
 
         prompt = (
-            "ユーザーの学習記録（会話履歴）は以下の通りです(JSON形式):\n"
-            f"```json\n{conversation_json_str}\n```\n\n"
+            f"{TRANSCRIPT_FORMAT_NOTE}\n\n"
+            "ユーザーの学習記録（会話履歴）は以下の通りです:\n"
+            f"{conversation_text}\n\n"
             "この学習内容に関連して、以下の形式で発展的な情報を自然な文章形式で提供してください：\n\n"
             "【関連分野と応用例】\n"
             "学習内容に関連する分野や、実際の応用例について説明してください。\n\n"
@@ -36,20 +43,20 @@ def generate_learning_insights(conversation_json):
             "学習内容が日常生活や他の分野でどのように活用できるか、具体的な例を挙げて説明してください。"
         )
 
-        print("\nCalling Gemini API for learning insights...")
-        response = client.models.generate_content(
-            model="gemini-1.5-flash",
+        insights_text = generate_text(
+            model=route.model,
             contents=prompt,
             config=types.GenerateContentConfig(
-                system_instruction=system_instruction
-            )
+                system_instruction=system_instruction,
+                **route.generation_settings
+            ),
+            service="insights"
         )
 
-        print("Raw Gemini response for learning insights:" + response.text)
-        return response.text
+        log.payload("Raw Gemini response for learning insights", insights_text, sample_key=conversation_json.get("user_id"))
+        return insights_text
 
     except Exception as e:
-        print(f"Error in generate_learning_insights: {e}")
-        import traceback
-        traceback.print_exc()
+        log.error("Error in generate_learning_insights", exc_info=True, user_id=conversation_json.get("user_id"), error=str(e))
+        raise_if_transient(e)
         return "学習内容の分析中にエラーが発生しました。" 
\ No newline at end of file
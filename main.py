@@ -1,282 +1,755 @@
+import time
+_import_started = time.perf_counter() # コールドスタート時のモジュール読み込み時間の計測用
+
 import functions_framework
 import flask
-from supabase import create_client, Client # Client は execute_daily_tasks で型ヒント用
-import traceback
-from datetime import timedelta, datetime, timezone
-import json
+from supabase import Client # Client は execute_daily_tasks で型ヒント用
+from datetime import timedelta, datetime, timezone, date
+from concurrent.futures import ThreadPoolExecutor
 
 # ローカルモジュールのインポート
-from utils import get_secret # Gemini client は各サービスファイルがutilsから直接インポート・使用
-from config import SECRET_URL_ID, SECRET_KEY_ID # Supabase接続情報
+from clients import registry # Supabase / Gemini client はプロセス内で使い回す
+from config import USER_WORKER_CONCURRENCY, GENERATION_MODE, GENERATION_MODES
+from config import SHARD_COUNT, SHARD_STRATEGY
+from config import ACTIVITY_WINDOW_MODE, ACTIVITY_WINDOW_MODES, WATERMARK_MAX_LOOKBACK_HOURS, WATERMARK_SAFETY_LAG_SECONDS
+from config import WATERMARK_INITIAL_LOOKBACK_HOURS
+from config import BACKFILL_MAX_DAYS, PROMPT_TOKEN_BUDGET, QUIZ_DEDUP_ENABLED
+from metrics import metrics
+from resilience import reset_retry_budgets
+import structured_log as log
+from stage_graph import StageGraph
+from prompt_encoding import encode_conversation, estimate_original_tokens
+from output_cache import configure_cache, summarize_cache
+from write_buffer import DailyWriteBuffer, PendingUserWrite
+from run_tracker import RunTracker, new_run_id, STATUS_SUCCEEDED, STATUS_FAILED
+from sharding import estimate_user_load, partition_by_count, partition_by_load, build_shard_specs, dispatch_shards, http_dispatcher
+from activity_loader import ACTIVITY_SOURCES, fetch_user_ids, load_activity_window, load_new_activity, build_conversation_json
+from watermarks import WatermarkStore
 from report_service import make_daily_report
 from quiz_service import make_daily_quizzes
-from learning_insight_service import generate_learning_insights
+from learning_insight_service import generate_learning_insights, INSIGHTS_SKIPPED_TEXT
+from combined_service import make_combined_outputs
+from gemini_client import IncompleteText
+from routing import choose_routes
+from quiz_index import load_quiz_index
+from activity_scoring import score_activity, fast_path_for, render_template_report, TEMPLATE_INSIGHTS_TEXT
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+log.info("main module imported", import_seconds=round(IMPORT_SECONDS, 3))
+
+JST = timezone(timedelta(hours=9), 'JST')
+
+# ユーザーごとの結果のうち DEBUG ログに出す項目 (レポート本文の抜粋は log.payload の抽出に任せて出さない)
+USER_RESULT_LOG_FIELDS = ("status", "reason", "generation_mode", "routing", "activity", "num_quizzes",
+                          "quiz_duplicates", "incomplete_stages", "prompt_tokens", "stage_latency_seconds")
+
+# 生成モードごとの1ユーザーあたりの Gemini 呼び出し回数 (簡易処理で省いた回数の見積もりに使う)
+GEMINI_CALLS_BY_MODE = {"separate": 3, "combined": 1}
+
+class RunContext:
+    """1回の呼び出しの中で、全ユーザーの処理が共有する状態"""
+
+    def __init__(self, generation_mode, stage_executor, write_buffer, folder_titles, quiz_index=None):
+        # ユーザーごとの保存先フォルダのタイトル {user_id: title}
+        self.folder_titles = folder_titles
+        self.write_buffer = write_buffer
+        self.generation_mode = generation_mode
+        # ユーザー内のステージ (report / quizzes / insights) を並列実行するためのプール。
+        # ユーザー用ワーカーがこのプールの完了を待つため、ユーザー用プールとは分けておく
+        self.stage_executor = stage_executor
+        # 過去の問題の索引 (重複除去が無効な場合は None)
+        self.quiz_index = quiz_index
+
+
+def generate_separately(conversation_json, stage_executor, routes, quiz_exclusions=None):
+    """
+    レポート・問題・アドバイスを個別の Gemini 呼び出しで生成する (routes はタスクごとの Route)。
+    quiz_exclusions は問題の生成時に避けるよう伝える過去の問題。
+    """
+    # insights はレポートに依存しないため report と並列に実行し、quizzes は report の完了後に開始する
+    graph = StageGraph()
+    graph.add("report", lambda: make_daily_report(conversation_json, routes["report"]))
+    if routes["insights"].skip:
+        metrics.incr("routing.insights_skipped")
+    else:
+        graph.add("insights", lambda: generate_learning_insights(conversation_json, routes["insights"]))
+    graph.add("quizzes",
+              lambda report: make_daily_quizzes(conversation_json, report, routes["quiz"], quiz_exclusions),
+              depends_on=("report",))
+    outputs, latencies = graph.run(stage_executor)
+    insights = outputs.get("insights", INSIGHTS_SKIPPED_TEXT)
+    return outputs["report"], outputs["quizzes"], insights, latencies
+
+
+def generate_outputs(conversation_json, generation_mode, stage_executor, routes, quiz_exclusions=None):
+    """
+    generation_mode に従ってレポート・問題・アドバイスを生成する。
+    routes は choose_routes が返すタスクごとのモデル・生成設定、quiz_exclusions は避けるべき過去の問題。
+    戻り値は (daily_report_text, daily_quizzes, insights, used_mode, latencies)。
+    combined の結果が検証に失敗した場合は used_mode を "combined_fallback" として個別生成に切り替える。
+    """
+    generation_started = time.perf_counter()
+    latencies = {}
+    used_mode = "separate"
+    if generation_mode == "combined":
+        combined_started = time.perf_counter()
+        combined = make_combined_outputs(conversation_json, routes["combined"], quiz_exclusions)
+        latencies["combined"] = time.perf_counter() - combined_started
+        if combined is not None:
+            used_mode = "combined"
+            daily_report_text, daily_quizzes, insights = combined.basic_report, combined.quizzes, combined.advanced_report
+        else:
+            used_mode = "combined_fallback"
+            log.warning("Falling back to separate generation", user_id=conversation_json['user_id'])
+
+    if used_mode != "combined":
+        daily_report_text, daily_quizzes, insights, separate_latencies = \
+            generate_separately(conversation_json, stage_executor, routes, quiz_exclusions)
+        latencies.update(separate_latencies)
+
+    latencies["generation_total"] = time.perf_counter() - generation_started
+    metrics.incr(f"generation.{used_mode}.users")
+    metrics.incr(f"generation.{used_mode}.latency_seconds", latencies["generation_total"])
+    return daily_report_text, daily_quizzes, insights, used_mode, latencies
+
+
+def summarize_generation_modes(counters):
+    """metrics のカウンターから生成モードごとのユーザー数・平均レイテンシ・トークン数をまとめる"""
+    services_by_mode = {"separate": ("report", "quiz", "insights"), "combined": ("combined",)}
+    summary = {}
+    for mode, services in services_by_mode.items():
+        users = counters.get(f"generation.{mode}.users", 0)
+        latency = counters.get(f"generation.{mode}.latency_seconds", 0)
+        if mode == "combined":
+            # フォールバックしたユーザーも combined を1回呼び出している
+            users += counters.get("generation.combined_fallback.users", 0)
+            latency += counters.get("generation.combined_fallback.latency_seconds", 0)
+        if not users and not any(counters.get(f"gemini.{svc}.calls") for svc in services):
+            continue
+        summary[mode] = {
+            "users": int(users),
+            "avg_generation_seconds": round(latency / users, 3) if users else None,
+            "calls": int(sum(counters.get(f"gemini.{svc}.calls", 0) for svc in services)),
+            "prompt_tokens": int(sum(counters.get(f"gemini.{svc}.prompt_tokens", 0) for svc in services)),
+            "output_tokens": int(sum(counters.get(f"gemini.{svc}.output_tokens", 0) for svc in services)),
+        }
+    if counters.get("generation.combined_fallback.users"):
+        summary["combined_fallback_users"] = int(counters["generation.combined_fallback.users"])
+    return summary
+
+
+def summarize_routing(counters):
+    """metrics のカウンターから区分ごとのユーザー数と、モデルごとの呼び出し回数・トークン数をまとめる"""
+    return {
+        "tiers": {name.split(".")[1]: int(value) for name, value in counters.items()
+                  if name.startswith("routing.") and name.endswith(".users")},
+        "insights_skipped": int(counters.get("routing.insights_skipped", 0)),
+        "models": {name[len("model."):]: int(value) for name, value in counters.items()
+                   if name.startswith("model.")},
+    }
+
+
+def summarize_fast_path(counters):
+    """metrics のカウンターから、活動量が少なく簡易処理したユーザー数と省いた Gemini 呼び出し回数をまとめる"""
+    return {
+        "skipped_users": int(counters.get("fast_path.skip.users", 0)),
+        "templated_users": int(counters.get("fast_path.template.users", 0)),
+        "avoided_gemini_calls": int(counters.get("fast_path.avoided_gemini_calls", 0)),
+    }
+
+
+def run_fast_path(ctx, user_id, conversation_json, activity_score, fast_path):
+    """
+    活動量の少ないユーザーを Gemini を呼ばずに処理し、(result, 保存内容) を返す。
+    "skip" は何も保存しない (incremental モードでは high-water mark を進めず、次回以降の活動と合わせて処理する)。
+    "template" は定型のレポートだけを保存し、問題は作らない。
+    """
+    metrics.incr(f"fast_path.{fast_path}.users")
+    metrics.incr("fast_path.avoided_gemini_calls", GEMINI_CALLS_BY_MODE[ctx.generation_mode])
+    log.debug("Low activity fast path", user_id=user_id, fast_path=fast_path, **activity_score.as_dict())
+    if fast_path == "skip":
+        return {"user_id": user_id, "status": "skipped", "reason": "low_activity",
+                "activity": activity_score.as_dict()}, None
+
+    folder_row = {
+        "user_id": user_id,
+        "title": ctx.folder_titles[user_id],
+        "description": "本日の学習活動のまとめ"
+    }
+    report_to_insert = {
+        "user_id": user_id,
+        "title": ctx.folder_titles[user_id],
+        "basic_report": render_template_report(conversation_json, activity_score),
+        "advanced_report": TEMPLATE_INSIGHTS_TEXT
+    }
+    result = {
+        "user_id": user_id,
+        "status": "success",
+        "generation_mode": "template",
+        "activity": activity_score.as_dict(),
+        "num_quizzes": 0
+    }
+    return result, PendingUserWrite(user_id, folder_row, [], report_to_insert, result)
+
+
+def run_user_tasks(ctx, user_id, activity):
+    """
+    1ユーザー分のレポート・クイズ・アドバイスを生成し、(result, 保存内容) を返す。
+    生成前に失敗した場合、保存内容は None になる。
+    """
+    log.debug("Processing tasks", user_id=user_id)
+    try:
+        conversation_json = build_conversation_json(user_id, activity)
+        log.payload("直近24時間の会話再現JSON", conversation_json, sample_key=user_id, user_id=user_id)
+
+        # 活動量の少ないユーザーは Gemini を呼ばずに処理する
+        activity_score = score_activity(conversation_json)
+        fast_path = fast_path_for(activity_score)
+        if fast_path is not None:
+            return run_fast_path(ctx, user_id, conversation_json, activity_score, fast_path)
+
+        # プロンプト用エンコードによるトークン削減量を記録する (各サービスも同じエンコードを使う)
+        encoded = encode_conversation(conversation_json)
+        # 会話量に応じて各タスクのモデル・生成設定を決める
+        routes = choose_routes(encoded)
+        tier = routes["report"].tier
+        if routes["report"].token_budget != PROMPT_TOKEN_BUDGET:
+            # 予算の大きいモデルに送る日は、実際に送る内容でトークン数を記録する
+            encoded = encode_conversation(conversation_json, routes["report"].token_budget)
+        original_tokens = estimate_original_tokens(conversation_json)
+        saved_tokens = max(0, original_tokens - encoded.tokens)
+        metrics.incr(f"routing.{tier}.users")
+        metrics.incr("prompt.original_tokens", original_tokens)
+        metrics.incr("prompt.encoded_tokens", encoded.tokens)
+        metrics.incr("prompt.dropped_turns", encoded.dropped_turns)
+        log.debug("Encoded conversation", user_id=user_id, tokens=encoded.tokens,
+                  saved_tokens=saved_tokens, dropped_turns=encoded.dropped_turns)
+
+        stage_latencies = {}
+        quiz_exclusions = ctx.quiz_index.recent_questions(user_id) if ctx.quiz_index is not None else None
+
+        # 各サービス関数呼び出し
+        daily_report_text, daily_quizzes, insights, used_mode, generation_latencies = \
+            generate_outputs(conversation_json, ctx.generation_mode, ctx.stage_executor, routes, quiz_exclusions)
+        stage_latencies.update(generation_latencies)
+        metrics.observe(f"routing.{tier}.generation", generation_latencies["generation_total"])
+        for stage, seconds in generation_latencies.items():
+            metrics.observe(f"stage.{stage}", seconds)
+
+        # 過去に出題した問題や同じ回の問題と重複するものは保存しない
+        quiz_duplicates = {"exact": 0, "near": 0}
+        if ctx.quiz_index is not None:
+            daily_quizzes, quiz_duplicates = ctx.quiz_index.filter_new(user_id, daily_quizzes)
+
+        # --- 保存内容の組み立て (書き込みは write_buffer がユーザーをまたいでまとめて行う) ---
+        folder_title = ctx.folder_titles[user_id]
+        folder_row = {
+            "user_id": user_id,
+            "title": folder_title,
+            "description": "本日の学習活動のまとめ"
+        }
+
+        tasks_to_insert = []
+        for quiz in daily_quizzes or []:
+            tasks_to_insert.append({
+                "user_id": user_id,
+                "question": quiz.question,
+                "answer": quiz.answer,
+                "status": "pending"
+                # "scheduled_at": None # 必要に応じて設定
+                # task_folder_id はフォルダ作成後に write_buffer が設定する
+            })
+        if not tasks_to_insert:
+            log.warning("No quizzes generated", user_id=user_id)
+
+        # daily_report_text や insights がエラー時に辞書型やNoneになる可能性を考慮
+        basic_report_str = daily_report_text
+        if isinstance(daily_report_text, dict):
+            basic_report_str = daily_report_text.get("summary", "レポート生成エラー")
+        elif not isinstance(daily_report_text, str):
+            basic_report_str = str(daily_report_text)
+
+        advanced_report_str = insights
+        if not isinstance(insights, str):
+            advanced_report_str = str(insights) # またはエラーを示す文字列
+
+        report_to_insert = {
+            "user_id": user_id,
+            "title": folder_title, # user_task_folders作成時のタイトルを流用
+            "basic_report": basic_report_str,
+            "advanced_report": advanced_report_str
+            # 前提: user_daily_report.task_folder_id は user_task_folders.id を参照
+        }
+
+        log.payload("デイリーレポート", basic_report_str, sample_key=user_id, user_id=user_id)
+        log.payload("発展的な学習アドバイス", advanced_report_str, sample_key=user_id, user_id=user_id)
+        log.payload("問題json", [quiz.model_dump() for quiz in daily_quizzes or []], sample_key=user_id, user_id=user_id)
+
+        # ストリーミングの期限や出力トークンの上限で打ち切られた出力も、未完了であることを明記したうえで保存する
+        incomplete_stages = [stage for stage, text in (("report", daily_report_text), ("insights", insights))
+                             if isinstance(text, IncompleteText)]
+        if incomplete_stages:
+            metrics.incr("generation.incomplete_users")
+            log.warning("Saving incomplete generation", user_id=user_id, stages=incomplete_stages)
+
+        result = {
+            "user_id": user_id,
+            "status": "success",
+            "generation_mode": used_mode,
+            "activity": activity_score.as_dict(),
+            "incomplete_stages": incomplete_stages,
+            "routing": {task: route.as_dict() for task, route in routes.items()},
+            "report_summary": daily_report_text["summary"] if isinstance(daily_report_text, dict) and "summary" in daily_report_text else daily_report_text[:100] + "..." if isinstance(daily_report_text, str) else "N/A",
+            "num_quizzes": len(daily_quizzes) if daily_quizzes else 0,
+            "quiz_duplicates": quiz_duplicates,
+            "insights_preview": insights[:100] + "..." if isinstance(insights, str) else "N/A",
+            "prompt_tokens": {
+                "encoded": encoded.tokens,
+                "original": original_tokens,
+                "saved": saved_tokens,
+                "dropped_turns": encoded.dropped_turns
+            },
+            "stage_latency_seconds": {stage: round(seconds, 3) for stage, seconds in stage_latencies.items()}
+        }
+        if incomplete_stages:
+            # 実行状況の error_details に残し、後から再生成の対象を探せるようにする
+            result["error_details"] = "incomplete: " + ", ".join(incomplete_stages)
+        return result, PendingUserWrite(user_id, folder_row, tasks_to_insert, report_to_insert, result)
+    except Exception as e_user:
+        # ユーザー単位でエラーを閉じ込め、他のユーザーの処理は継続する
+        log.error("Error processing tasks", exc_info=True, user_id=user_id, error=str(e_user))
+        return {
+            "user_id": user_id,
+            "status": "error",
+            "error_details": str(e_user)
+        }, None
+
+
+def record_statuses(tracker, results):
+    """ユーザーの結果に応じて (user_id, run_date) の処理状況をまとめて記録する (活動量が少なく省いたユーザーは成功扱い)"""
+    updates = [
+        (r["user_id"], STATUS_FAILED if r["status"] == "error" else STATUS_SUCCEEDED,
+         r.get("task_folder_id"), r.get("error_details"))
+        for r in results
+    ]
+    try:
+        tracker.mark_many(updates)
+    except Exception as e_mark:
+        # 状況の記録に失敗しても、次回の実行で再処理されるだけなので処理は継続する
+        log.error("Failed to record run status", exc_info=True, num_users=len(updates), error=str(e_mark))
+
+
+def advance_watermarks(watermark_store, user_ids, end_time_str):
+    """
+    user_ids の全テーブルの high-water mark を取得範囲の終端まで進める。
+    書き込みまで成功したユーザーと活動のなかったユーザーに使い、失敗・保留したユーザーの位置は残して次回に遡らせる。
+    """
+    marks = {user_id: {source: (end_time_str, None) for source in ACTIVITY_SOURCES} for user_id in user_ids}
+    try:
+        watermark_store.advance(marks)
+    except Exception as e_mark:
+        # 進められなかったユーザーは次回の実行で同じ行を再処理する
+        log.error("Failed to advance watermarks", exc_info=True, num_users=len(marks), error=str(e_mark))
+
+
+def pin_watermarks(watermark_store, user_ids, start_time_str):
+    """
+    処理を見送ったユーザーのうち high-water mark のないものを、今回の取得開始位置に固定する。
+    固定しないと次回は既定の開始位置 (実行時刻から WATERMARK_INITIAL_LOOKBACK_HOURS 前) から取得するため、
+    今回の行が取得範囲から外れて処理されないままになる。
+    """
+    try:
+        watermark_store.pin(user_ids, ACTIVITY_SOURCES, start_time_str)
+    except Exception as e_mark:
+        log.error("Failed to pin watermarks", exc_info=True, num_users=len(user_ids), error=str(e_mark))
+
+
+def process_user(ctx, user_id, activity):
+    """
+    ユーザーの生成処理を実行し、保存内容を write_buffer に渡す。
+    返した result は書き込み完了時に write_buffer が成否で更新する。
+    """
+    result, pending_write = run_user_tasks(ctx, user_id, activity)
+    if ctx.quiz_index is not None:
+        ctx.quiz_index.release(user_id)
+    log.debug("User generation finished", user_id=user_id,
+              **{field: result[field] for field in USER_RESULT_LOG_FIELDS if field in result})
+    if pending_write is None:
+        # 保存するもののないユーザー (活動量による省略・生成前の失敗) も、実行状況はフラッシュ時にまとめて記録する
+        pending_write = PendingUserWrite(user_id, None, [], None, result)
+    ctx.write_buffer.add(pending_write)
+    return result
+
+def resolve_window(request_json, window_mode):
+    """
+    会話履歴の取得範囲と実行日を決める。
+    coordinator から window が渡された場合は全シャードで同じ範囲を使う。
+    incremental モードの start は high-water mark のないユーザーの取得開始位置になる。
+    """
+    window = request_json.get("window")
+    if window:
+        start_time_str, end_time_str = window["start"], window["end"]
+        now_jst = datetime.fromisoformat(end_time_str).astimezone(JST)
+    else:
+        # 取得範囲は実行開始時点で1度だけ決め、全ユーザーで共有する
+        now_jst = datetime.now(JST)
+        if window_mode == "incremental":
+            # 終端付近はコミットの遅れた行が後から現れることがあるため、次回の実行に回す
+            now_jst -= timedelta(seconds=WATERMARK_SAFETY_LAG_SECONDS)
+            start_time_str = (now_jst - timedelta(hours=WATERMARK_INITIAL_LOOKBACK_HOURS)).isoformat()
+        else:
+            start_time_str = (now_jst - timedelta(hours=24)).isoformat()
+        end_time_str = now_jst.isoformat()
+    run_date = request_json.get("run_date") or now_jst.strftime('%Y-%m-%d')
+    return start_time_str, end_time_str, run_date
+
+
+def load_activity(supabase, window_mode, watermark_store, start_time_str, end_time_str, user_ids, by_user_ids):
+    """
+    window_mode に応じて対象ユーザーの会話履歴をまとめて取得する。
+    by_user_ids が False の場合はテーブル全体を走査して user_ids の分をふるい分け、True の場合は user_id のチャンク単位で取得する。
+    """
+    if watermark_store is not None:
+        watermarks = watermark_store.load(user_ids)
+    if window_mode != "incremental":
+        return load_activity_window(supabase, start_time_str, end_time_str,
+                                    user_ids=user_ids if by_user_ids else None)
+    floor_start_str = (datetime.fromisoformat(end_time_str)
+                       - timedelta(hours=WATERMARK_MAX_LOOKBACK_HOURS)).isoformat()
+    return load_new_activity(supabase, watermarks, start_time_str, floor_start_str, end_time_str,
+                             user_ids, by_user_ids=by_user_ids)
+
+
+def folder_title_for(run_date, window_mode, window_start_str=None):
+    """
+    保存先フォルダのタイトル。(user_id, title) で upsert するため、同じタイトルの再実行はフォルダを上書きする。
+    incremental モードは1日に複数回実行できるよう、ユーザーの取得開始位置 (window_start_str) をタイトルに含める。
+    失敗したユーザーは位置が進まず次回も同じ位置から処理するため、途中まで書き込んだフォルダが上書きされる。
+    """
+    if window_mode == "incremental":
+        return f"{datetime.fromisoformat(window_start_str).astimezone(JST):%Y-%m-%d %H:%M:%S} 以降の学習記録"
+    return f"{run_date} の学習記録"
+
+
+def run_daily_tasks(supabase, request_json, generation_mode, cache):
+    """
+    ユーザーごとの処理を実行し、実行結果のまとめを返す。
+    request_json に shard が含まれる場合 (worker モード) は、そのシャードのユーザーだけを処理する。
+    window_mode が "incremental" の場合、または advance_watermarks が指定された場合 (backfill) は、
+    書き込みまで成功したユーザーと活動のなかったユーザーの high-water mark を取得範囲の終端まで進める。
+    """
+    shard = request_json.get("shard")
+    window_mode = request_json.get("window_mode", ACTIVITY_WINDOW_MODE)
+
+    # --- 対象ユーザーのIDを取得 ---
+    if shard is not None:
+        user_ids = list(shard["user_ids"])
+        log.info("Worker shard received", shard=shard['index'], shard_count=shard['count'], num_users=len(user_ids))
+    else:
+        with metrics.timer("fetch.users"):
+            user_ids = fetch_user_ids(supabase)
+        log.info("Found users", num_users=len(user_ids))
+
+    # --- 未処理の会話履歴を対象ユーザー分まとめて取得 ---
+    start_time_str, end_time_str, run_date = resolve_window(request_json, window_mode)
+    log.info("会話履歴の取得範囲", window_mode=window_mode, start=start_time_str, end=end_time_str)
+    watermark_store = None
+    if window_mode == "incremental" or request_json.get("advance_watermarks"):
+        watermark_store = WatermarkStore(supabase)
+    with metrics.timer("fetch.activity"):
+        activity_by_user = load_activity(supabase, window_mode, watermark_store, start_time_str, end_time_str,
+                                         user_ids, by_user_ids=shard is not None)
+
+    all_user_task_results = []
+    active_user_ids = []
+    for user_id in user_ids:
+        if user_id in activity_by_user:
+            active_user_ids.append(user_id)
+        else:
+            # 活動のないユーザーはフォルダ作成・Gemini呼び出しを行わない
+            all_user_task_results.append({"user_id": user_id, "status": "skipped", "reason": "no_activity"})
+
+    # --- 実行状況の確認: 同じ日にすでに成功したユーザーは再処理しない ---
+    run_id = request_json.get("run_id") or new_run_id()
+    tracker = RunTracker(supabase, run_date, run_id)
+    if window_mode == "incremental":
+        # 処理済みの行は high-water mark で除外済みなので、同じ日に成功済みのユーザーでも新しい行があれば処理する
+        pending_user_ids = active_user_ids
+    else:
+        pending_user_ids = tracker.pending_user_ids(active_user_ids)
+    pending_set = set(pending_user_ids)
+    for user_id in active_user_ids:
+        if user_id not in pending_set:
+            all_user_task_results.append({"user_id": user_id, "status": "skipped", "reason": "already_completed"})
+
+    # max_users を指定すると、1日分の処理を複数回の呼び出しに分けられる
+    max_users = request_json.get("max_users")
+    users_to_process = pending_user_ids[:int(max_users)] if max_users else pending_user_ids
+    num_deferred = len(pending_user_ids) - len(users_to_process)
+    log.info("Run planned", run_id=run_id, run_date=run_date, pending_users=len(pending_user_ids),
+             processing_users=len(users_to_process), deferred_users=num_deferred,
+             worker_concurrency=USER_WORKER_CONCURRENCY)
+    tracker.mark_started(users_to_process)
+
+    # --- 保存先フォルダのタイトルと、過去の問題の索引 ---
+    folder_titles = {
+        user_id: folder_title_for(run_date, window_mode, activity_by_user[user_id].get("window_start"))
+        for user_id in users_to_process
+    }
+    # 索引はユーザーの処理が進むのに合わせてチャンク単位で読み込み、処理の終わったユーザーの分から捨てる
+    quiz_index = load_quiz_index(supabase, users_to_process, folder_titles) if QUIZ_DEDUP_ENABLED else None
+
+    # --- ユーザーごとの処理をワーカープールで並列実行 ---
+    with ThreadPoolExecutor(max_workers=USER_WORKER_CONCURRENCY * 2) as stage_executor, \
+            ThreadPoolExecutor(max_workers=USER_WORKER_CONCURRENCY) as executor:
+        def on_flushed(entries):
+            results = [e.result for e in entries]
+            record_statuses(tracker, results)
+            if watermark_store is not None:
+                advance_watermarks(watermark_store, [r["user_id"] for r in results if r["status"] == "success"],
+                                   end_time_str)
+
+        write_buffer = DailyWriteBuffer(supabase, on_flushed=on_flushed)
+        ctx = RunContext(generation_mode, stage_executor, write_buffer, folder_titles, quiz_index)
+        try:
+            futures = [
+                executor.submit(process_user, ctx, user_id, activity_by_user[user_id])
+                for user_id in users_to_process
+            ]
+            # 入力順に結果を集める (process_user は例外を外に出さない)
+            user_results = [future.result() for future in futures]
+        finally:
+            # 残っている書き込みをすべて反映してから結果を確定する
+            write_buffer.close()
+        all_user_task_results.extend(user_results)
+    if watermark_store is not None:
+        # 活動のなかったユーザーと、同じ日にすでに成功していたユーザーも終端まで進め、
+        # 次回の取得範囲が古い位置まで遡らないようにする
+        done = {r["user_id"] for r in all_user_task_results
+                if r["status"] == "success" or r.get("reason") in ("no_activity", "already_completed")}
+        advance_watermarks(watermark_store, [r["user_id"] for r in all_user_task_results
+                                             if r.get("reason") in ("no_activity", "already_completed")],
+                           end_time_str)
+        # 失敗・省略・保留したユーザーは、位置がなければ今回の開始位置に固定して次回以降に持ち越す
+        pin_watermarks(watermark_store, [user_id for user_id in active_user_ids if user_id not in done],
+                       start_time_str)
+
+    num_skipped = sum(1 for r in all_user_task_results if r["status"] == "skipped")
+    num_failed = sum(1 for r in all_user_task_results if r["status"] == "error")
+    counters = metrics.snapshot()
+    if cache is not None:
+        cache.prune()
+    # ユーザーごとの結果を全件出力する代わりに、件数・失敗ユーザー・レイテンシ分布をまとめて出力する
+    log.info(
+        "Run summary",
+        run_id=run_id,
+        run_date=run_date,
+        window_mode=window_mode,
+        shard=shard["index"] if shard is not None else None,
+        users={"total": len(user_ids), "processed": len(users_to_process), "skipped": num_skipped,
+               "failed": num_failed, "deferred": num_deferred,
+               "incomplete": int(counters.get('generation.incomplete_users', 0))},
+        failed_users=[{"user_id": r["user_id"], "stage": r.get("stage"), "error": r.get("error_details")}
+                      for r in all_user_task_results if r["status"] == "error"][:50],
+        latency_seconds=metrics.latency_summary(),
+        gemini_tokens={name: int(value) for name, value in counters.items()
+                       if name.startswith("gemini.") and name.endswith("_tokens")},
+        prompt_tokens={"encoded": int(counters.get('prompt.encoded_tokens', 0)),
+                       "original": int(counters.get('prompt.original_tokens', 0)),
+                       "dropped_turns": int(counters.get('prompt.dropped_turns', 0))},
+        writes={"users": int(counters.get('writes.users', 0)), "flushes": int(counters.get('writes.flushes', 0)),
+                "round_trips": int(counters.get('writes.round_trips', 0))},
+        output_cache=summarize_cache(counters) if cache is not None else None,
+        resilience={name: int(value) for name, value in counters.items()
+                    if name.startswith(("retry.", "circuit.")) or name.endswith(".errors")},
+        generation_modes=summarize_generation_modes(counters),
+        routing=summarize_routing(counters),
+        fast_path=summarize_fast_path(counters),
+        quiz_dedup={"history_questions": int(counters.get("quiz_index.history_questions", 0)),
+                    "kept": int(counters.get("quiz_index.kept", 0)),
+                    "exact_duplicates": int(counters.get("quiz_index.exact_duplicates", 0)),
+                    "near_duplicates": int(counters.get("quiz_index.near_duplicates", 0))},
+    )
+
+    return {
+        "run_id": run_id,
+        "run_date": run_date,
+        "window_mode": window_mode,
+        "shard": shard["index"] if shard is not None else None,
+        "num_users": len(user_ids),
+        "processed_user_ids": users_to_process,
+        "failed_user_ids": [r["user_id"] for r in all_user_task_results if r["status"] == "error"],
+        "num_skipped": num_skipped,
+        "num_deferred": num_deferred,
+    }
+
+
+def coordinate(supabase, request_json, dispatcher):
+    """
+    ユーザーをシャードに分割し、各シャードを worker モードの呼び出しとして並列に実行する。
+    全シャードで同じ run_id・run_date・取得範囲を使う。
+    """
+    shard_count = int(request_json.get("shard_count", SHARD_COUNT))
+    strategy = request_json.get("shard_strategy", SHARD_STRATEGY)
+    window_mode = request_json.get("window_mode", ACTIVITY_WINDOW_MODE)
+    start_time_str, end_time_str, run_date = resolve_window(request_json, window_mode)
+    run_id = request_json.get("run_id") or new_run_id()
+
+    user_ids = fetch_user_ids(supabase)
+    if strategy == "load":
+        # 活動のある未完了ユーザーだけを、推定トークン量が均等になるように分割する
+        watermark_store = WatermarkStore(supabase) if window_mode == "incremental" else None
+        activity_by_user = load_activity(supabase, window_mode, watermark_store, start_time_str, end_time_str,
+                                         user_ids, by_user_ids=False)
+        active_user_ids = [user_id for user_id in user_ids if user_id in activity_by_user]
+        if window_mode == "incremental":
+            candidates = active_user_ids
+            # 活動のないユーザーはどのシャードにも渡らないため、ここで終端まで進める
+            advance_watermarks(watermark_store, [user_id for user_id in user_ids if user_id not in activity_by_user],
+                               end_time_str)
+        else:
+            candidates = RunTracker(supabase, run_date, run_id).pending_user_ids(active_user_ids)
+        loads = {user_id: estimate_user_load(activity_by_user[user_id]) for user_id in candidates}
+        shards = partition_by_load(candidates, loads, shard_count)
+    elif strategy == "count":
+        # 会話履歴を読まずにユーザー数だけで分割する (活動の有無は各 worker が判定する)
+        candidates = user_ids
+        loads = None
+        shards = partition_by_count(candidates, shard_count)
+    else:
+        return {"error": f"Unknown shard_strategy: {strategy}"}, 400
+
+    shard_specs = build_shard_specs(shards, loads)
+    log.info("Dispatching shards", run_id=run_id, num_users=len(candidates), num_shards=len(shard_specs),
+             strategy=strategy)
+
+    base_body = {
+        "run_id": run_id,
+        "run_date": run_date,
+        "window_mode": window_mode,
+        "window": {"start": start_time_str, "end": end_time_str},
+    }
+    if "generation_mode" in request_json:
+        base_body["generation_mode"] = request_json["generation_mode"]
+    shard_results = dispatch_shards(shard_specs, base_body, dispatcher)
+
+    failed_shards = [r["shard"] for r in shard_results if r.get("status") != 200]
+    summary = {
+        "run_id": run_id,
+        "run_date": run_date,
+        "num_users": len(candidates),
+        "num_shards": len(shard_specs),
+        "failed_shards": failed_shards,
+        "shards": shard_results,
+    }
+    log.info("Coordinator finished", run_id=run_id, failed_shards=failed_shards)
+    # 失敗したシャードがあれば呼び出し元 (スケジューラ) の再試行に任せる。成功済みユーザーは再処理されない
+    return summary, 502 if failed_shards else 200
+
+
+def parse_backfill_range(backfill):
+    """backfill の {"start_date", "end_date"} を (開始日, 終了日) にする。不正な指定は ValueError"""
+    if not isinstance(backfill, dict) or "start_date" not in backfill:
+        raise ValueError("backfill requires start_date")
+    first_day = date.fromisoformat(backfill["start_date"])
+    last_day = date.fromisoformat(backfill.get("end_date", backfill["start_date"]))
+    num_days = (last_day - first_day).days + 1
+    if not 1 <= num_days <= BACKFILL_MAX_DAYS:
+        raise ValueError(f"backfill must cover 1 to {BACKFILL_MAX_DAYS} days, got {num_days}")
+    return first_day, last_day
+
+
+def run_backfill(supabase, request_json, generation_mode, cache, first_day, last_day):
+    """
+    first_day から last_day まで (JST) を1日ずつ、その日の0時から24時までの固定範囲で処理する。
+    実行状況は run_date ごとに記録されるため、途中で止まっても同じ呼び出しで未完了のユーザーから再開できる。
+    処理した行の位置は high-water mark に反映する (すでに先に進んでいる位置は巻き戻さない)。
+    """
+    num_days = (last_day - first_day).days + 1
+    day_summaries = []
+    for offset in range(num_days):
+        day = first_day + timedelta(days=offset)
+        day_start = datetime(day.year, day.month, day.day, tzinfo=JST)
+        day_body = {key: value for key, value in request_json.items() if key != "backfill"}
+        day_body.update({
+            "window_mode": "rolling",
+            "window": {"start": day_start.isoformat(),
+                       "end": (day_start + timedelta(days=1, microseconds=-1)).isoformat()},
+            "run_date": day.isoformat(),
+            "advance_watermarks": True,
+        })
+        # 日ごとの Run summary がその日の件数・レイテンシだけを表すよう、日ごとに集計を戻す
+        metrics.reset()
+        day_summaries.append(run_daily_tasks(supabase, day_body, generation_mode, cache))
+    return {
+        "start_date": first_day.isoformat(),
+        "end_date": last_day.isoformat(),
+        "num_processed": sum(len(summary["processed_user_ids"]) for summary in day_summaries),
+        "num_failed": sum(len(summary["failed_user_ids"]) for summary in day_summaries),
+        "days": day_summaries,
+    }
+
 
 @functions_framework.http
 def execute_daily_tasks(request: flask.Request):
-    """その日の会話をjsonにまとめ、各サービス関数に渡す"""
+    """
+    その日の会話をjsonにまとめ、各サービス関数に渡す。
+    mode: "single" (既定, 1回の呼び出しで全ユーザーを処理) / "coordinator" (シャードに分割して worker を呼び出す) /
+    "worker" (リクエストボディの shard に含まれるユーザーだけを処理する)
+    window_mode: "rolling" (直近24時間) / "incremental" (ユーザーごとの high-water mark 以降)
+    backfill: {"start_date": "YYYY-MM-DD", "end_date": "YYYY-MM-DD"} を指定すると、その期間を1日ずつ処理する
+    """
     try:
-        supabase_url = get_secret(SECRET_URL_ID)
-        supabase_key = get_secret(SECRET_KEY_ID)
-        supabase: Client = create_client(supabase_url, supabase_key)
-        print("Supabase client initialized in main.")
-
-        # --- 全ユーザーのIDを取得 ---
-        users_res = supabase.table('users').select('user_id').execute()
-        if not users_res.data:
-            print("No users found.")
-            return "No users found.", 200
-        
-        user_ids = [user['user_id'] for user in users_res.data]
-        print(f"Found {len(user_ids)} users: {user_ids}")
-
-        all_user_task_results = []
-
-        for user_id in user_ids:
-            print(f"--- Processing tasks for user_id: {user_id} ---")
+        metrics.reset()
+        reset_retry_budgets()
+        request_json = request.get_json(silent=True) or {}
+        generation_mode = request_json.get("generation_mode", GENERATION_MODE)
+        if generation_mode not in GENERATION_MODES:
+            return f"Unknown generation_mode: {generation_mode}", 400
+        log.info("Request received", generation_mode=generation_mode, mode=request_json.get("mode", "single"))
+
+        mode = request_json.get("mode", "single")
+        if mode not in ("single", "coordinator", "worker"):
+            return f"Unknown mode: {mode}", 400
+        window_mode = request_json.get("window_mode", ACTIVITY_WINDOW_MODE)
+        if window_mode not in ACTIVITY_WINDOW_MODES:
+            return f"Unknown window_mode: {window_mode}", 400
+        if "backfill" in request_json:
+            if mode != "single":
+                return "backfill is only supported in single mode", 400
             try:
-                # --- 直近24時間の会話履歴の取得と再現 (ユーザーごと) ---
-                jst = timezone(timedelta(hours=9), 'JST')
-                now_jst = datetime.now(jst)
-                twenty_four_hours_ago_jst = now_jst - timedelta(hours=24)
-                start_time_str = twenty_four_hours_ago_jst.isoformat()
-                end_time_str = now_jst.isoformat()
-                print(f"直近24時間の取得範囲: {start_time_str} 〜 {end_time_str} (JST) for user {user_id}")
-
-                # messages取得 (user_idでフィルタリング)
-                # messagesテーブルに user_id カラムが存在すると仮定
-                messages_res = supabase.table('messages') \
-                    .select('*') \
-                    .eq('user_id', user_id) \
-                    .gte('created_at', start_time_str) \
-                    .lte('created_at', end_time_str) \
-                    .order('created_at') \
-                    .execute()
-                messages = messages_res.data
-
-                # posts取得 (user_idでフィルタリング)
-                # postsテーブルに user_id カラムが存在すると仮定
-                posts_res = supabase.table('posts') \
-                    .select('*') \
-                    .eq('user_id', user_id) \
-                    .gte('created_at', start_time_str) \
-                    .lte('created_at', end_time_str) \
-                    .order('created_at') \
-                    .execute()
-                posts = posts_res.data
-
-                # post_messages_to_ai取得
-                # まずユーザーの投稿IDリストを取得
-                user_post_ids = [post['id'] for post in posts]
-                post_messages_to_ai = []
-                if user_post_ids:
-                    post_ai_res = supabase.table('post_messages_to_ai') \
-                        .select('*') \
-                        .in_('post_id', user_post_ids) \
-                        .gte('created_at', start_time_str) \
-                        .lte('created_at', end_time_str) \
-                        .order('created_at') \
-                        .execute()
-                    post_messages_to_ai = post_ai_res.data
-
-                # messages: room_idごとにまとめ、created_at順
-                messages_by_room = {}
-                for msg in messages:
-                    room_id = msg['room_id']
-                    if room_id not in messages_by_room:
-                        messages_by_room[room_id] = []
-                    messages_by_room[room_id].append({
-                        "role": msg['role'],
-                        "content": msg['content'],
-                        "created_at": msg['created_at']
-                    })
-                # posts, post_messages_to_ai: post_idで紐付け、created_at順
-                posts_dict = {post['id']: post for post in posts}
-                post_ai_by_post = {}
-                for ai_msg in post_messages_to_ai:
-                    post_id = ai_msg['post_id']
-                    if post_id not in post_ai_by_post:
-                        post_ai_by_post[post_id] = []
-                    post_ai_by_post[post_id].append({
-                        "role": ai_msg['role'],
-                        "content": ai_msg['content'],
-                        "created_at": ai_msg['created_at']
-                    })
-                # postsごとにユーザーとAIの会話を再現
-                posts_conversations = []
-                for post in posts:
-                    conv = []
-                    conv.append({
-                        "role": "user",
-                        "comment": post['comment'],
-                        "created_at": post['created_at']
-                    })
-                    ai_msgs = post_ai_by_post.get(post['id'], [])
-                    conv.extend(sorted(ai_msgs, key=lambda x: x['created_at']))
-                    posts_conversations.append({
-                        "post_id": post['id'],
-                        "conversation": conv
-                    })
-                # 全体json
-                conversation_json = {
-                    "user_id": user_id, # ユーザーIDをjsonに含める
-                    "messages_by_room": messages_by_room,
-                    "posts_conversations": posts_conversations
-                }
-                print(f"--- 直近24時間の会話再現JSON for user {user_id} ---")
-                print(json.dumps(conversation_json, ensure_ascii=False, indent=2))
-                print("----------------------------------")
-
-                # --- 1. タスクフォルダの作成 ---
-                current_task_folder_id = None
-                try:
-                    folder_title = f"{now_jst.strftime('%Y-%m-%d')} の学習記録"
-                    folder_description = "本日の学習活動のまとめ"
-                    
-                    insert_folder_res = supabase.table("user_task_folders").insert({
-                        "user_id": user_id,
-                        "title": folder_title,
-                        "description": folder_description
-                    }).execute()
-                    
-                    if insert_folder_res.data:
-                        current_task_folder_id = insert_folder_res.data[0]['id']
-                        print(f"Created task folder {current_task_folder_id} for user {user_id}")
-                    else:
-                        print(f"Failed to create task folder for user {user_id}. Response: {insert_folder_res}")
-                        # フォルダ作成失敗時はこのユーザーの以降の処理をスキップ
-                        all_user_task_results.append({
-                            "user_id": user_id, "status": "error", 
-                            "error_details": "Failed to create task folder",
-                            "stage": "create_task_folder"
-                        })
-                        continue 
-                except Exception as e_folder:
-                    print(f"Exception creating task folder for user {user_id}: {e_folder}")
-                    traceback.print_exc()
-                    all_user_task_results.append({
-                        "user_id": user_id, "status": "error", 
-                        "error_details": str(e_folder),
-                        "stage": "create_task_folder"
-                    })
-                    continue
-
-                # 各サービス関数呼び出し
-                daily_report_text = make_daily_report(conversation_json)
-                daily_quizzes = make_daily_quizzes(conversation_json, daily_report_text)
-                insights = generate_learning_insights(conversation_json)
-
-                # --- 2. デイリークイズの保存 (user_tasks) ---
-                if daily_quizzes:
-                    tasks_to_insert = []
-                    for quiz in daily_quizzes:
-                        tasks_to_insert.append({
-                            "user_id": user_id,
-                            "question": quiz.question,
-                            "answer": quiz.answer,
-                            "task_folder_id": current_task_folder_id,
-                            "status": "pending"
-                            # "scheduled_at": None # 必要に応じて設定
-                        })
-                    
-                    if tasks_to_insert:
-                        try:
-                            insert_tasks_res = supabase.table("user_tasks").insert(tasks_to_insert).execute()
-                            if insert_tasks_res.data:
-                                print(f"Inserted {len(insert_tasks_res.data)} tasks for user {user_id} into folder {current_task_folder_id}")
-                            else:
-                                print(f"Failed to insert tasks for user {user_id}. Response: {insert_tasks_res}")
-                                # タスク保存失敗を記録するが、レポート保存は試みる場合もある
-                        except Exception as e_tasks:
-                            print(f"Exception inserting tasks for user {user_id}: {e_tasks}")
-                            traceback.print_exc()
-                else:
-                    print(f"No quizzes generated for user {user_id}.")
-
-                # --- 3. 日次レポートの保存 (user_daily_report) ---
-                # daily_report_text や insights がエラー時に辞書型やNoneになる可能性を考慮
-                basic_report_str = daily_report_text
-                if isinstance(daily_report_text, dict):
-                    basic_report_str = daily_report_text.get("summary", "レポート生成エラー")
-                elif not isinstance(daily_report_text, str):
-                    basic_report_str = str(daily_report_text)
-
-                advanced_report_str = insights
-                if not isinstance(insights, str):
-                    advanced_report_str = str(insights) # またはエラーを示す文字列
-
-                try:
-                    report_to_insert = {
-                        "user_id": user_id,
-                        "title": folder_title, # user_task_folders作成時のタイトルを流用
-                        "basic_report": basic_report_str,
-                        "advanced_report": advanced_report_str,
-                        "task_folder_id": current_task_folder_id 
-                        # 前提: user_daily_report.task_folder_id は user_task_folders.id を参照
-                    }
-                    insert_report_res = supabase.table("user_daily_report").insert(report_to_insert).execute()
-                    if insert_report_res.data:
-                        print(f"Inserted daily report for user {user_id} into folder {current_task_folder_id}")
-                    else:
-                        print(f"Failed to insert daily report for user {user_id}. Response: {insert_report_res}")
-                except Exception as e_report:
-                    print(f"Exception inserting daily report for user {user_id}: {e_report}")
-                    traceback.print_exc()
-                
-                print(f"--- デイリーレポート for user {user_id} ---")
-                # daily_report_text が辞書の場合（エラー時など）も考慮
-                if isinstance(daily_report_text, dict) and "summary" in daily_report_text:
-                    print(daily_report_text["summary"])
-                else:
-                    print(daily_report_text) 
-                print("--------------------")
-
-                print(f"--- 発展的な学習アドバイス for user {user_id} ---")
-                print(insights)
-                print("--------------------")
-
-                print(f"--- 問題json for user {user_id} ---")
-                if daily_quizzes: # daily_quizzes がNoneや空でないことを確認
-                    try:
-                        quizzes_as_dicts = [quiz.model_dump() for quiz in daily_quizzes] # Pydantic V2の場合
-                        print(json.dumps(quizzes_as_dicts, ensure_ascii=False, indent=2))
-                    except AttributeError: # Pydantic V1の場合など model_dump がない場合
-                        try:
-                            quizzes_as_dicts = [quiz.dict() for quiz in daily_quizzes] # Pydantic V1の場合
-                            print(json.dumps(quizzes_as_dicts, ensure_ascii=False, indent=2))
-                        except Exception as e_dict:
-                            print(f"Failed to serialize quizzes to JSON using .dict(): {e_dict}")
-                            print(f"Quizzes data: {daily_quizzes}")
-                    except Exception as e_model_dump:
-                         print(f"Failed to serialize quizzes with model_dump: {e_model_dump}")
-                         print(f"Quizzes data: {daily_quizzes}")
-                else:
-                    print("生成された問題はありませんでした。")
-                print("----------------")
-
-                all_user_task_results.append({
-                    "user_id": user_id,
-                    "status": "success",
-                    "report_summary": daily_report_text["summary"] if isinstance(daily_report_text, dict) and "summary" in daily_report_text else daily_report_text[:100] + "..." if isinstance(daily_report_text, str) else "N/A",
-                    "num_quizzes": len(daily_quizzes) if daily_quizzes else 0,
-                    "insights_preview": insights[:100] + "..." if isinstance(insights, str) else "N/A"
-                })
-            except Exception as e_user:
-                print(f"Error processing tasks for user_id {user_id}: {e_user}")
-                traceback.print_exc()
-                all_user_task_results.append({
-                    "user_id": user_id,
-                    "status": "error",
-                    "error_details": str(e_user)
-                })
-                continue # 次のユーザーの処理へ
-
-        print("--- All user processing finished ---")
-        print(json.dumps(all_user_task_results, ensure_ascii=False, indent=2))
-        return f"Tasks executed for {len(user_ids)} users. See logs for details.", 200
+                backfill_range = parse_backfill_range(request_json["backfill"])
+            except ValueError as e:
+                return f"Invalid backfill: {e}", 400
+
+        # シークレットはキャッシュになければ並列に取得し、クライアントは2回目以降の呼び出しで使い回す
+        init_started = time.perf_counter()
+        registry.prefetch()
+        supabase: Client = registry.supabase()
+        init_seconds = time.perf_counter() - init_started
+        log.info("Clients ready", init_seconds=round(init_seconds, 3), import_seconds=round(IMPORT_SECONDS, 3))
+
+        if mode == "coordinator":
+            summary, status = coordinate(supabase, request_json, http_dispatcher())
+            summary["init_seconds"] = round(init_seconds, 3)
+            return summary, status
+
+        cache = configure_cache(supabase)
+        if "backfill" in request_json:
+            summary = run_backfill(supabase, request_json, generation_mode, cache, *backfill_range)
+            return (f"Backfill executed for {len(summary['days'])} days from {summary['start_date']} "
+                    f"({summary['num_processed']} user-days processed, {summary['num_failed']} failed). "
+                    "See logs for details."), 200
+        summary = run_daily_tasks(supabase, request_json, generation_mode, cache)
+        summary["init_seconds"] = round(init_seconds, 3)
+        summary["import_seconds"] = round(IMPORT_SECONDS, 3)
+        if mode == "worker":
+            return summary, 200
+        return (f"Tasks executed for {len(summary['processed_user_ids'])} of {summary['num_users']} users "
+                f"in run {summary['run_id']} ({len(summary['failed_user_ids'])} failed, "
+                f"{summary['num_deferred']} remaining). See logs for details."), 200
     except Exception as e:
-        print(f"An error occurred in execute_daily_tasks: {e}")
-        traceback.print_exc()
+        log.error("An error occurred in execute_daily_tasks", exc_info=True, error=str(e))
         return "内部エラーが発生しました。", 500
 
 # supabase処理と、instant_report削除
\ No newline at end of file
@@ -0,0 +1,79 @@
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# 1つの指標あたりに保持するレイテンシのサンプル数の上限 (超えたらリザーバーサンプリングする)
+MAX_SAMPLES_PER_NAME = 10_000
+
+
+class Metrics:
+    """実行中に集計するスレッドセーフなカウンターとレイテンシ分布"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._samples = defaultdict(list)
+        self._sample_counts = defaultdict(int)
+        self._random = random.Random(0)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name, seconds):
+        """レイテンシを1件記録する"""
+        with self._lock:
+            self._sample_counts[name] += 1
+            samples = self._samples[name]
+            if len(samples) < MAX_SAMPLES_PER_NAME:
+                samples.append(seconds)
+            else:
+                index = self._random.randrange(self._sample_counts[name])
+                if index < MAX_SAMPLES_PER_NAME:
+                    samples[index] = seconds
+
+    @contextmanager
+    def timer(self, name):
+        """with ブロックの実行時間を name のレイテンシとして記録する"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._samples.clear()
+            self._sample_counts.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def latency_summary(self):
+        """レイテンシごとの件数・p50・p95・最大値 (秒) を返す"""
+        with self._lock:
+            items = {name: (sorted(samples), self._sample_counts[name]) for name, samples in self._samples.items()}
+        return {
+            name: {
+                "count": count,
+                "p50": round(_percentile(samples, 50), 3),
+                "p95": round(_percentile(samples, 95), 3),
+                "max": round(samples[-1], 3),
+            }
+            for name, (samples, count) in sorted(items.items()) if samples
+        }
+
+
+def _percentile(sorted_samples, pct):
+    """最近傍法でパーセンタイルを求める"""
+    index = max(0, min(len(sorted_samples) - 1, math.ceil(pct / 100 * len(sorted_samples)) - 1))
+    return sorted_samples[index]
+
+
+# プロセス全体で共有するメトリクス (execute_daily_tasks の開始時にリセットする)
+metrics = Metrics()
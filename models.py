@@ -2,4 +2,10 @@ from pydantic import BaseModel
 
 class Quiz(BaseModel):
   question: str
-  answer: str 
\ No newline at end of file
+  answer: str
+
+class DailyOutputs(BaseModel):
+  """combined モードで1回の呼び出しからまとめて受け取る出力"""
+  basic_report: str
+  quizzes: list[Quiz]
+  advanced_report: str
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from activity_loader import chunked
+from config import (
+    ACTIVITY_FETCH_KEY_CHUNK_SIZE, OUTPUT_CACHE_BACKEND, OUTPUT_CACHE_TTL_SECONDS, OUTPUT_CACHE_MAX_ENTRIES,
+    OUTPUT_CACHE_SQLITE_PATH, OUTPUT_CACHE_TABLE,
+)
+from metrics import metrics
+import structured_log as log
+
+
+def cache_key(service, model, system_instruction, payload):
+    """(サービス, モデル, システム指示, 正規化済みペイロード) から SHA-256 のキーを作る"""
+    material = json.dumps([service, model, system_instruction or "", payload], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class SQLiteCacheBackend:
+    """ローカル実行・テスト用の SQLite バックエンド。最終アクセスが古いものから件数上限で削除する"""
+
+    def __init__(self, path=OUTPUT_CACHE_SQLITE_PATH, max_entries=OUTPUT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS output_cache ("
+            "key TEXT PRIMARY KEY, service TEXT, value TEXT, created_at REAL, accessed_at REAL)"
+        )
+        self._conn.commit()
+
+    def get(self, key, ttl_seconds):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM output_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] + ttl_seconds < now:
+                self._conn.execute("DELETE FROM output_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE output_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return row[0]
+
+    def set(self, key, service, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO output_cache (key, service, value, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, service, value, now, now),
+            )
+            self._conn.execute(
+                "DELETE FROM output_cache WHERE key IN ("
+                "SELECT key FROM output_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def prune(self, ttl_seconds):
+        with self._lock:
+            self._conn.execute("DELETE FROM output_cache WHERE created_at < ?", (time.time() - ttl_seconds,))
+            self._conn.commit()
+
+
+class SupabaseCacheBackend:
+    """
+    本番用の Supabase テーブルバックエンド。
+    前提: テーブル (key text primary key, service text, value text, created_at timestamptz)
+    書き込みのたびに件数を数えるのは高コストなため、期限切れ・件数超過分の削除は prune でまとめて行う。
+    """
+
+    def __init__(self, supabase, table=OUTPUT_CACHE_TABLE, max_entries=OUTPUT_CACHE_MAX_ENTRIES):
+        self.supabase = supabase
+        self.table = table
+        self.max_entries = max_entries
+
+    def get(self, key, ttl_seconds):
+        res = self.supabase.table(self.table).select('value, created_at').eq('key', key).limit(1).execute()
+        if not res.data:
+            return None
+        created_at = datetime.fromisoformat(res.data[0]['created_at'])
+        if created_at + timedelta(seconds=ttl_seconds) < datetime.now(timezone.utc):
+            return None
+        return res.data[0]['value']
+
+    def set(self, key, service, value):
+        self.supabase.table(self.table).upsert({
+            "key": key,
+            "service": service,
+            "value": value,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }, on_conflict='key').execute()
+
+    def prune(self, ttl_seconds):
+        expired_before = (datetime.now(timezone.utc) - timedelta(seconds=ttl_seconds)).isoformat()
+        self.supabase.table(self.table).delete().lt('created_at', expired_before).execute()
+        # 件数上限を超えた古いエントリを削除する
+        overflow = self.supabase.table(self.table).select('key') \
+            .order('created_at', desc=True) \
+            .range(self.max_entries, self.max_entries + 999) \
+            .execute()
+        stale_keys = [row['key'] for row in overflow.data or []]
+        # SHA-256 のキーは長いため、URL の長さの上限を超えないよう IN 句をチャンクに分ける
+        for chunk in chunked(stale_keys, ACTIVITY_FETCH_KEY_CHUNK_SIZE):
+            self.supabase.table(self.table).delete().in_('key', chunk).execute()
+
+
+class OutputCache:
+    """Gemini の出力テキストをキャッシュする。バックエンドの障害は生成処理を止めずにミス扱いにする"""
+
+    def __init__(self, backend, ttl_seconds=OUTPUT_CACHE_TTL_SECONDS):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, key, service):
+        try:
+            value = self.backend.get(key, self.ttl_seconds)
+        except Exception as e:
+            log.warning("Output cache lookup failed", service=service, error=str(e))
+            value = None
+        metrics.incr(f"cache.{service}.hits" if value is not None else f"cache.{service}.misses")
+        return value
+
+    def set(self, key, service, value):
+        try:
+            self.backend.set(key, service, value)
+        except Exception as e:
+            log.warning("Output cache store failed", service=service, error=str(e))
+
+    def prune(self):
+        try:
+            self.backend.prune(self.ttl_seconds)
+        except Exception as e:
+            log.error("Output cache prune failed", exc_info=True, error=str(e))
+
+
+# execute_daily_tasks から configure_cache で設定する。None のときはキャッシュを使わない
+_cache = None
+
+
+def configure_cache(supabase, backend_name=OUTPUT_CACHE_BACKEND):
+    """設定に応じてプロセス共有のキャッシュを用意する ("none" / "sqlite" / "supabase")"""
+    global _cache
+    if backend_name == "sqlite":
+        if _cache is None or not isinstance(_cache.backend, SQLiteCacheBackend):
+            _cache = OutputCache(SQLiteCacheBackend())
+    elif backend_name == "supabase":
+        _cache = OutputCache(SupabaseCacheBackend(supabase))
+    elif backend_name == "none":
+        _cache = None
+    else:
+        raise ValueError(f"Unknown OUTPUT_CACHE_BACKEND: {backend_name}")
+    return _cache
+
+
+def get_cache():
+    return _cache
+
+
+def summarize_cache(counters):
+    """metrics のカウンターからサービスごとのキャッシュヒット・ミス数をまとめる"""
+    summary = {}
+    for name, value in counters.items():
+        if name.startswith("cache."):
+            _, service, kind = name.split(".")
+            summary.setdefault(service, {"hits": 0, "misses": 0})[kind] = int(value)
+    return summary
@@ -0,0 +1,143 @@
+import json
+from dataclasses import dataclass
+from datetime import datetime
+
+from config import PROMPT_TOKEN_BUDGET, PROMPT_RECENT_TURNS_KEPT, PROMPT_MAX_TURN_CHARS
+
+# プロンプト内で会話履歴の形式を説明する一文 (各サービスのプロンプトで共通に使う)
+TRANSCRIPT_FORMAT_NOTE = (
+    "会話履歴は「## room <ルームID>」(チャット) と「## post <投稿ID>」(投稿とAIの返信) ごとに区切られ、"
+    "各行は「[時刻] 発言者: 内容」の形式です。「(…N件省略)」は長さの都合で省いた発言を表します。"
+)
+
+
+@dataclass
+class EncodedConversation:
+    """プロンプト用にエンコードした会話履歴と、そのトークン数の見積もり"""
+    text: str
+    tokens: int
+    kept_turns: int
+    dropped_turns: int
+
+
+def estimate_tokens(text):
+    """文字数からトークン数を概算する (日本語は1トークンあたりおよそ2文字)"""
+    return max(1, len(text) // 2)
+
+
+def estimate_original_tokens(conversation_json):
+    """従来の json.dumps(indent=2) で送った場合のトークン数の見積もり (削減量の記録用。ユーザーごとに1回だけ呼ぶ)"""
+    return estimate_tokens(json.dumps(conversation_json, ensure_ascii=False, indent=2))
+
+
+def _short_time(created_at):
+    """ISO形式の created_at を HH:MM に縮める。解釈できなければそのまま返す"""
+    try:
+        return datetime.fromisoformat(str(created_at)).strftime("%H:%M")
+    except ValueError:
+        return str(created_at)
+
+
+def _clip(text, limit=PROMPT_MAX_TURN_CHARS):
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def _collect_segments(conversation_json):
+    """会話JSONを (見出し, [発言行, ...]) のリストに変換する"""
+    segments = []
+    for room_id, messages in conversation_json.get("messages_by_room", {}).items():
+        lines = [
+            f"[{_short_time(m['created_at'])}] {m['role']}: {_clip(m['content'])}"
+            for m in messages
+        ]
+        segments.append((f"## room {room_id}", lines, [m['created_at'] for m in messages]))
+    for post in conversation_json.get("posts_conversations", []):
+        lines = []
+        for turn in post["conversation"]:
+            body = turn.get("comment") if "comment" in turn else turn.get("content")
+            label = "user(投稿)" if "comment" in turn else turn["role"]
+            lines.append(f"[{_short_time(turn['created_at'])}] {label}: {_clip(body)}")
+        segments.append((f"## post {post['post_id']}", lines, [t['created_at'] for t in post["conversation"]]))
+    return segments
+
+
+def _informativeness(line, role_is_user):
+    """発言の情報量の目安。ユーザーの質問や長めの発言を優先する"""
+    score = min(len(line), 400) / 400
+    if role_is_user:
+        score += 0.5
+    if "?" in line or "？" in line:
+        score += 0.5
+    return score
+
+
+def _select_turns(segments, budget):
+    """
+    予算内に収まるよう残す発言を選ぶ。
+    直近の PROMPT_RECENT_TURNS_KEPT 件を優先し、残りの予算は情報量の多い発言から埋める。
+    """
+    turns = []
+    for seg_index, (_, lines, timestamps) in enumerate(segments):
+        for line_index, line in enumerate(lines):
+            role_is_user = "] user" in line
+            turns.append({
+                "key": (seg_index, line_index),
+                "created_at": str(timestamps[line_index]),
+                "tokens": estimate_tokens(line) + 1,
+                "score": _informativeness(line, role_is_user),
+            })
+
+    by_recency = sorted(turns, key=lambda t: t["created_at"], reverse=True)
+    kept = set()
+    used = 0
+    for turn in by_recency[:PROMPT_RECENT_TURNS_KEPT]:
+        if used + turn["tokens"] <= budget:
+            kept.add(turn["key"])
+            used += turn["tokens"]
+    for turn in sorted(by_recency[PROMPT_RECENT_TURNS_KEPT:], key=lambda t: t["score"], reverse=True):
+        if used + turn["tokens"] <= budget:
+            kept.add(turn["key"])
+            used += turn["tokens"]
+    return kept
+
+
+def encode_conversation(conversation_json, token_budget=PROMPT_TOKEN_BUDGET):
+    """
+    会話JSONをコンパクトなトランスクリプト形式に変換し、token_budget を超える場合は発言を間引く。
+    間引いた箇所には省略件数を示す行を残す。
+    """
+    segments = _collect_segments(conversation_json)
+    header_tokens = sum(estimate_tokens(heading) + 1 for heading, _, _ in segments)
+    total_tokens = header_tokens + sum(estimate_tokens(line) + 1 for _, lines, _ in segments for line in lines)
+
+    kept = None
+    if total_tokens > token_budget:
+        kept = _select_turns(segments, max(0, token_budget - header_tokens))
+
+    out_lines = []
+    kept_turns = 0
+    dropped_turns = 0
+    for seg_index, (heading, lines, _) in enumerate(segments):
+        out_lines.append(heading)
+        skipped = 0
+        for line_index, line in enumerate(lines):
+            if kept is None or (seg_index, line_index) in kept:
+                if skipped:
+                    out_lines.append(f"(…{skipped}件省略)")
+                    skipped = 0
+                out_lines.append(line)
+                kept_turns += 1
+            else:
+                skipped += 1
+                dropped_turns += 1
+        if skipped:
+            out_lines.append(f"(…{skipped}件省略)")
+
+    text = "\n".join(out_lines)
+    return EncodedConversation(
+        text=text,
+        tokens=estimate_tokens(text),
+        kept_turns=kept_turns,
+        dropped_turns=dropped_turns,
+    )
@@ -0,0 +1,277 @@
+import hashlib
+import re
+import threading
+import unicodedata
+import zlib
+from array import array
+from datetime import datetime, timedelta, timezone
+
+from activity_loader import chunked, iter_pages
+from config import (
+    ACTIVITY_FETCH_KEY_CHUNK_SIZE,
+    QUIZ_HISTORY_FUNCTION,
+    QUIZ_INDEX_LOAD_USERS,
+    QUIZ_INDEX_LOOKBACK_DAYS,
+    QUIZ_INDEX_MAX_PER_USER,
+    QUIZ_NEAR_DUPLICATE_SIMILARITY,
+    QUIZ_SHINGLE_SIZE,
+    QUIZ_MINHASH_SIZE,
+    QUIZ_LSH_KEYS,
+    QUIZ_PROMPT_EXCLUSIONS,
+    QUIZ_PROMPT_EXCLUSION_CHARS,
+)
+from metrics import metrics
+import structured_log as log
+
+# 署名が QUIZ_MINHASH_SIZE 個に満たない (短い問題文の) 場合の埋め草
+_EMPTY = 0xFFFFFFFF
+_IGNORED_CHARS = re.compile(r"[\W_]+")
+
+
+def normalize_question(text):
+    """表記ゆれ (全角・半角、大文字・小文字、空白、記号) を除いた比較用の問題文"""
+    return _IGNORED_CHARS.sub("", unicodedata.normalize("NFKC", text or "").lower())
+
+
+def question_hash(normalized):
+    """正規化した問題文の64ビットのハッシュ (完全一致の判定に使う)"""
+    return int.from_bytes(hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def minhash_signature(normalized):
+    """
+    正規化した問題文の文字 n-gram の MinHash 署名。
+    n-gram ごとのハッシュ値のうち小さい方から QUIZ_MINHASH_SIZE 個を昇順に並べたもの (bottom-k)。
+    ハッシュ関数を署名の長さだけ用意する方式より、1問あたりの計算量が n-gram 数に比例するだけで済む。
+    """
+    if len(normalized) <= QUIZ_SHINGLE_SIZE:
+        shingles = {normalized}
+    else:
+        shingles = {normalized[i:i + QUIZ_SHINGLE_SIZE] for i in range(len(normalized) - QUIZ_SHINGLE_SIZE + 1)}
+    return sorted({zlib.crc32(shingle.encode("utf-8")) for shingle in shingles})[:QUIZ_MINHASH_SIZE]
+
+
+def estimate_similarity(signature, other):
+    """2つの bottom-k 署名から n-gram 集合の Jaccard 係数を推定する"""
+    union = sorted(set(signature).union(other))[:QUIZ_MINHASH_SIZE]
+    if not union:
+        return 0.0
+    both = set(signature).intersection(other)
+    return sum(1 for value in union if value in both) / len(union)
+
+
+class _UserQuizIndex:
+    """
+    1ユーザー分の過去の問題。問題文そのものは持たず、完全一致用のハッシュの集合と、
+    配列に詰めた署名・署名の先頭側のハッシュ値から問題の位置を引く辞書だけを保持する。
+    プロンプト用に直近の問題文だけを別に残す。
+    """
+
+    def __init__(self):
+        self.exact = set()
+        self.signatures = array("I")
+        # 署名の先頭 QUIZ_LSH_KEYS 個のハッシュ値 -> そのハッシュ値を持つ問題の位置 (1件なら int、複数なら list)。
+        # 似た問題は最小側のハッシュ値を共有しやすいため、候補の絞り込みに使う
+        self.candidates = {}
+        self.recent_questions = []
+
+    def __len__(self):
+        return len(self.signatures) // QUIZ_MINHASH_SIZE
+
+    def add(self, normalized, signature):
+        position = len(self)
+        self.exact.add(question_hash(normalized))
+        self.signatures.extend(signature + [_EMPTY] * (QUIZ_MINHASH_SIZE - len(signature)))
+        for key in signature[:QUIZ_LSH_KEYS]:
+            positions = self.candidates.get(key)
+            if positions is None:
+                self.candidates[key] = position
+            elif isinstance(positions, int):
+                self.candidates[key] = [positions, position]
+            else:
+                positions.append(position)
+
+    def duplicate_kind(self, normalized, signature):
+        """過去の問題と重複していれば "exact" / "near"、していなければ None"""
+        if question_hash(normalized) in self.exact:
+            return "exact"
+        # 最小側のハッシュ値を共有する問題だけ、署名全体で類似度を推定する
+        checked = set()
+        for key in signature[:QUIZ_LSH_KEYS]:
+            positions = self.candidates.get(key)
+            if positions is None:
+                continue
+            for position in [positions] if isinstance(positions, int) else positions:
+                if position in checked:
+                    continue
+                checked.add(position)
+                if estimate_similarity(signature, self._signature(position)) >= QUIZ_NEAR_DUPLICATE_SIMILARITY:
+                    return "near"
+        return None
+
+    def _signature(self, position):
+        start = position * QUIZ_MINHASH_SIZE
+        return [value for value in self.signatures[start:start + QUIZ_MINHASH_SIZE] if value != _EMPTY]
+
+
+class QuizIndex:
+    """
+    ユーザーごとの過去の問題の索引。filter_new で新しい問題から重複を除く。
+    load_chunk を渡した場合は、chunks のユーザーをチャンクごとに、そのチャンクのユーザーが最初に必要になった時点で
+    load_chunk(quiz_index, user_ids) で読み込む。処理の終わったユーザーを release で捨てることで、
+    同時に保持するのは処理中のチャンクの分だけになる。
+    ユーザーごとの処理は1つのワーカーだけが行うため、ユーザー単位の索引はロックせずに更新する。
+    """
+
+    def __init__(self, load_chunk=None, chunks=()):
+        self._users = {}
+        self._lock = threading.Lock()
+        self._load_chunk = load_chunk
+        self._chunks = [list(chunk) for chunk in chunks]
+        self._chunk_of = {user_id: i for i, chunk in enumerate(self._chunks) for user_id in chunk}
+        self._chunk_locks = [threading.Lock() for _ in self._chunks]
+        self._loaded_chunks = set()
+        self._released = set()
+
+    def _ensure_loaded(self, user_id):
+        i = self._chunk_of.get(user_id)
+        if i is None:
+            return
+        # 同じチャンクを待つワーカーは、先に読み込みを始めたワーカーの完了を待つ
+        with self._chunk_locks[i]:
+            if i in self._loaded_chunks:
+                return
+            self._loaded_chunks.add(i)
+            try:
+                self._load_chunk(self, self._chunks[i])
+            except Exception as e:
+                # 読み込めなくても生成は続ける (同じ回の問題どうしの重複だけを除く)
+                log.error("Failed to load quiz index", exc_info=True, num_users=len(self._chunks[i]), error=str(e))
+
+    def _user(self, user_id):
+        self._ensure_loaded(user_id)
+        with self._lock:
+            return self._users.setdefault(user_id, _UserQuizIndex())
+
+    def release(self, user_id):
+        """処理の終わったユーザーの索引を捨てる (その後にチャンクが読み込まれても、このユーザーの分は保持しない)"""
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._released.add(user_id)
+
+    def add_history(self, user_id, question):
+        normalized = normalize_question(question)
+        if not normalized:
+            return
+        with self._lock:
+            if user_id in self._released:
+                return
+            index = self._users.setdefault(user_id, _UserQuizIndex())
+        index.add(normalized, minhash_signature(normalized))
+        if len(index.recent_questions) < QUIZ_PROMPT_EXCLUSIONS:
+            index.recent_questions.append(question[:QUIZ_PROMPT_EXCLUSION_CHARS])
+
+    def recent_questions(self, user_id):
+        """プロンプトで避けるよう伝える直近の過去の問題 (新しい順)"""
+        self._ensure_loaded(user_id)
+        with self._lock:
+            index = self._users.get(user_id)
+        return list(index.recent_questions) if index is not None else []
+
+    def filter_new(self, user_id, quizzes):
+        """
+        過去の問題や同じ回の他の問題と重複しない Quiz だけを返す。残した問題は索引に追加する。
+        戻り値は (残した Quiz のリスト, {"exact": 件数, "near": 件数})。
+        """
+        index = self._user(user_id)
+        kept = []
+        dropped = {"exact": 0, "near": 0}
+        for quiz in quizzes or []:
+            normalized = normalize_question(quiz.question)
+            signature = minhash_signature(normalized)
+            kind = index.duplicate_kind(normalized, signature) if normalized else None
+            if kind is not None:
+                dropped[kind] += 1
+                continue
+            kept.append(quiz)
+            if normalized:
+                index.add(normalized, signature)
+        metrics.incr("quiz_index.kept", len(kept))
+        metrics.incr("quiz_index.exact_duplicates", dropped["exact"])
+        metrics.incr("quiz_index.near_duplicates", dropped["near"])
+        if dropped["exact"] or dropped["near"]:
+            log.debug("Dropped duplicate quizzes", user_id=user_id, **dropped)
+        return kept, dropped
+
+
+def load_quiz_index(supabase, user_ids, folder_titles=None, now=None):
+    """
+    対象ユーザーの過去の問題 (user_tasks) を新しい順に QUIZ_INDEX_MAX_PER_USER 件ずつ読み込む QuizIndex を返す。
+    読み込みはユーザーの処理順に QUIZ_INDEX_LOAD_USERS 人ずつ、そのユーザーが最初に必要になった時点で行う。
+    処理の終わったユーザーを release すれば、ユーザー数によらず保持する問題はおよそ QUIZ_INDEX_MAX_QUESTIONS 件までになる。
+    folder_titles ({user_id: title}) のフォルダの問題は今回の書き込みで置き換えるため、読み込まない
+    (同じフォルダへの再実行で自分自身と重複させない)。
+    ユーザーごとの件数の上限は SQL 関数の中で適用し、上限を超える古い問題は転送しない。
+    前提: 次の SQL 関数 QUIZ_HISTORY_FUNCTION があること。
+        create function recent_quiz_questions(p_user_ids uuid[], p_since timestamptz, p_per_user_limit int,
+                                              p_exclude_folder_ids bigint[])
+        returns table (user_id uuid, question text, created_at timestamptz, id bigint) language sql stable as $$
+          select user_id, question, created_at, id from (
+            select t.user_id, t.question, t.created_at, t.id,
+                   row_number() over (partition by t.user_id order by t.created_at desc, t.id desc) as rank
+            from user_tasks t
+            where t.user_id = any(p_user_ids) and (p_since is null or t.created_at >= p_since)
+              and (t.task_folder_id is null or t.task_folder_id <> all(p_exclude_folder_ids))
+          ) ranked where rank <= p_per_user_limit
+        $$;
+    """
+    folder_titles = folder_titles or {}
+    since = None
+    if QUIZ_INDEX_LOOKBACK_DAYS > 0:
+        since = ((now or datetime.now(timezone.utc)) - timedelta(days=QUIZ_INDEX_LOOKBACK_DAYS)).isoformat()
+
+    def load_chunk(quiz_index, chunk):
+        with metrics.timer("fetch.quiz_index"):
+            num_questions = _load_history(supabase, quiz_index, chunk, folder_titles, since)
+        metrics.incr("quiz_index.history_questions", num_questions)
+        log.debug("Loaded quiz index", num_users=len(chunk), num_questions=num_questions)
+
+    return QuizIndex(load_chunk, chunked(list(user_ids), QUIZ_INDEX_LOAD_USERS))
+
+
+def _load_history(supabase, quiz_index, user_ids, folder_titles, since):
+    """user_ids の過去の問題を quiz_index に追加し、追加した問題数を返す"""
+    replaced_folder_ids = set()
+    for chunk in chunked(user_ids, ACTIVITY_FETCH_KEY_CHUNK_SIZE):
+        titles = {folder_titles[user_id] for user_id in chunk if user_id in folder_titles}
+        if titles:
+            res = supabase.table("user_task_folders") \
+                .select('id, user_id, title') \
+                .in_('title', sorted(titles)) \
+                .in_('user_id', chunk) \
+                .execute()
+            replaced_folder_ids.update(row['id'] for row in res.data or []
+                                       if folder_titles.get(row['user_id']) == row['title'])
+
+    def build_query():
+        return supabase.rpc(QUIZ_HISTORY_FUNCTION, {
+            "p_user_ids": user_ids,
+            "p_since": since,
+            "p_per_user_limit": QUIZ_INDEX_MAX_PER_USER,
+            "p_exclude_folder_ids": sorted(replaced_folder_ids),
+        }).order('user_id').order('created_at', desc=True).order('id', desc=True)
+
+    num_questions = 0
+    for page in iter_pages(build_query):
+        for row in page:
+            quiz_index.add_history(row['user_id'], row['question'])
+        num_questions += len(page)
+    return num_questions
+
+
+def exclusion_note(questions):
+    """過去の問題をプロンプトで避けるよう伝える文。questions が空なら空文字列"""
+    if not questions:
+        return ""
+    lines = "\n".join(f"- {question}" for question in questions)
+    return f"\n\n過去に出題した問題 (これらと同じ問題や言い回しを変えただけの問題は作らないでください):\n{lines}"
@@ -1,21 +1,40 @@
 import json
-import traceback
 from google.genai import types # `types` を直接インポート
-from utils import client # client は utils で初期化されたものを使用
+from gemini_client import generate_content # レート制限付きで Gemini client を呼び出す
 from models import Quiz # Quiz モデルをインポート
+from prompt_encoding import encode_conversation, TRANSCRIPT_FORMAT_NOTE
+import structured_log as log
+from resilience import raise_if_transient
+from routing import default_route
+from quiz_index import exclusion_note
 
-def make_daily_quizzes(conversation_json, report):
-    """会話内容とレポートを元に問題を数問json形式で出力"""
+def _is_json(text):
+    """キャッシュに保存してよいか判定するため、JSONとして解釈できるか確認する"""
     try:
-        print("--- make_daily_quizzes ---")
-        response = client.models.generate_content(
-            model='gemini-1.5-flash',
-            contents='会話履歴:\n' + json.dumps(conversation_json, ensure_ascii=False, indent=2) + '\n\n日報:\n' + str(report) + '\n\nこの会話と日報をもとに、ユーザーの学力向上に役立つ問題を数問作成してください。問題はquestionとanswerの両方を含み、JSONリスト形式で返してください。',
+        json.loads(text)
+        return True
+    except ValueError:
+        return False
+
+def make_daily_quizzes(conversation_json, report, route=None, exclusions=None):
+    """
+    会話内容とレポートを元に問題を数問json形式で出力 (route でモデルと生成設定を指定できる)。
+    exclusions に過去の問題を渡すと、それらと重複しないようプロンプトで指示する。
+    """
+    route = route or default_route("quiz")
+    user_id = conversation_json.get("user_id")
+    try:
+        response = generate_content(
+            model=route.model,
+            contents=TRANSCRIPT_FORMAT_NOTE + '\n\n会話履歴:\n' + encode_conversation(conversation_json, route.token_budget).text + '\n\n日報:\n' + str(report) + '\n\nこの会話と日報をもとに、ユーザーの学力向上に役立つ問題を数問作成してください。問題はquestionとanswerの両方を含み、JSONリスト形式で返してください。' + exclusion_note(exclusions),
             config=types.GenerateContentConfig(
                 system_instruction='あなたは経験豊富な学習メンターです。学習者の理解度に合わせた効果的な問題を作成するのが得意です。',
                 response_mime_type='application/json',
-                response_schema=list[Quiz]
-            )
+                response_schema=list[Quiz],
+                **route.generation_settings
+            ),
+            service="quiz",
+            validate=_is_json
         )
 
         # response.textからJSONを解析する
@@ -26,7 +45,7 @@ def make_daily_quizzes(conversation_json, report):
                 if isinstance(json_data, dict) and "questions" in json_data:
                     json_data = json_data.get("questions", [])
                 else:
-                    print(f"Expected JSON array but got: {type(json_data)}")
+                    log.warning("Expected JSON array", user_id=user_id, got=type(json_data).__name__)
                     return []
             
             quizzes = []
@@ -36,27 +55,26 @@ def make_daily_quizzes(conversation_json, report):
                         quiz = Quiz(question=item["question"], answer=item["answer"])
                         quizzes.append(quiz)
                     else:
-                        print(f"Skipping quiz item missing required fields: {item}")
+                        log.warning("Skipping quiz item missing required fields", user_id=user_id, item=item)
                 except Exception as e:
-                    print(f"Error converting item to Quiz: {e}, item: {item}")
+                    log.warning("Error converting item to Quiz", user_id=user_id, error=str(e), item=item)
             
             if not quizzes:
-                print("No valid quizzes were found in the response")
+                log.warning("No valid quizzes were found in the response", user_id=user_id)
             else:
-                print(f"Successfully parsed {len(quizzes)} quizzes")
+                log.debug("Parsed quizzes", user_id=user_id, num_quizzes=len(quizzes))
             
             return quizzes
             
         except json.JSONDecodeError as e:
-            print(f"Failed to parse JSON from Gemini response: {e}")
-            print(f"Raw text: {response.text}")
+            log.warning("Failed to parse JSON from Gemini response", user_id=user_id, error=str(e))
+            log.payload("Raw text", response.text, sample_key=user_id, user_id=user_id)
             return []
         except Exception as e:
-            print(f"Unexpected error while processing quizzes: {e}")
-            traceback.print_exc()
+            log.error("Unexpected error while processing quizzes", exc_info=True, user_id=user_id, error=str(e))
             return []
             
     except Exception as e:
-        print(f"Error in make_daily_quizzes: {e}")
-        traceback.print_exc()
+        log.error("Error in make_daily_quizzes", exc_info=True, user_id=user_id, error=str(e))
+        raise_if_transient(e)
         return [] 
\ No newline at end of file
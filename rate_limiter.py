@@ -0,0 +1,59 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """スレッドセーフなトークンバケット。capacity まで貯まり、毎秒 refill_per_second ずつ補充される"""
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.refill_per_second)
+
+    def acquire(self, amount=1):
+        """amount 分のトークンが貯まるまで待機して消費する。待機した秒数を返す"""
+        # capacity を超える要求は永久に満たされないため capacity で頭打ちにする
+        amount = min(float(amount), self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return waited
+                wait_seconds = (amount - self._tokens) / self.refill_per_second
+            time.sleep(wait_seconds)
+            waited += wait_seconds
+
+    def adjust(self, delta):
+        """実際の消費量との差分を反映する (正なら追加消費、負なら返却)。残高は負になってもよい"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens - delta)
+
+
+class GeminiRateLimiter:
+    """Gemini API の requests-per-minute と tokens-per-minute を同時に制御する"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self._requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0)
+        self._tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0)
+
+    def acquire(self, estimated_tokens):
+        """1リクエスト分と推定トークン分の枠を確保する。待機した秒数を返す"""
+        waited = self._tokens.acquire(estimated_tokens)
+        waited += self._requests.acquire(1)
+        return waited
+
+    def reconcile(self, estimated_tokens, actual_tokens):
+        """レスポンスの usage_metadata から得た実トークン数で推定との差を補正する"""
+        if actual_tokens is not None:
+            self._tokens.adjust(actual_tokens - estimated_tokens)
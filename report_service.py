@@ -1,16 +1,15 @@
-import json
-import traceback
 from google.genai import types # `types` を直接インポート
-from utils import client # client は utils で初期化されたものを使用
+from gemini_client import generate_text # レート制限付きで Gemini client を呼び出す (設定によりストリーミング)
+from prompt_encoding import encode_conversation, TRANSCRIPT_FORMAT_NOTE
+import structured_log as log
+from resilience import raise_if_transient
+from routing import default_route
 
-def make_daily_report(conversation_json):
-    """会話内容を元に、Gemini APIを使用して詳細な学習レポートを作成"""
+def make_daily_report(conversation_json, route=None):
+    """会話内容を元に、Gemini APIを使用して詳細な学習レポートを作成 (route でモデルと生成設定を指定できる)"""
+    route = route or default_route("report")
     try:
-        print("--- make_daily_report ---")
-        # conversation_jsonの表示は必要に応じてコメント解除
-        # print(json.dumps(conversation_json, ensure_ascii=False, indent=2))
-
-        conversation_text = json.dumps(conversation_json, ensure_ascii=False, indent=2)
+        conversation_text = encode_conversation(conversation_json, route.token_budget).text
 
         system_instruction = (
             "あなたは経験豊富な学習メンターです。"
@@ -20,24 +19,27 @@ def make_daily_report(conversation_json):
         )
         
         prompt_contents = (
-            f"会話履歴:\n```json\n{conversation_text}\n```\n\n"
+            f"{TRANSCRIPT_FORMAT_NOTE}\n\n"
+            f"会話履歴:\n{conversation_text}\n\n"
             "上記会話履歴に基づいて、本日の学習のまとめとアドバイスを作成してください。"
         )
 
-        response = client.models.generate_content(
-            model="gemini-1.5-flash",
+        report_text = generate_text(
+            model=route.model,
             contents=prompt_contents,
             config=types.GenerateContentConfig(
-                system_instruction=system_instruction
+                system_instruction=system_instruction,
                 # response_mime_type はテキストなので不要
-            )
+                **route.generation_settings
+            ),
+            service="report"
         )
-        print("make_daily_report response:" + response.text)
-        return response.text # テキストレポートを返す
+        log.payload("make_daily_report response", report_text, sample_key=conversation_json.get("user_id"))
+        return report_text # テキストレポートを返す (期限で打ち切られた場合は IncompleteText)
 
     except Exception as e:
-        print(f"Error in make_daily_report: {e}")
-        traceback.print_exc()
+        log.error("Error in make_daily_report", exc_info=True, user_id=conversation_json.get("user_id"), error=str(e))
+        raise_if_transient(e)
         return {
             "summary": "レポート生成中にエラーが発生しました。",
             "error_details": str(e),
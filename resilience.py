@@ -0,0 +1,265 @@
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from config import (
+    RETRY_MAX_ATTEMPTS,
+    RETRY_BASE_DELAY_SECONDS,
+    RETRY_MAX_DELAY_SECONDS,
+    RETRY_AFTER_MAX_SECONDS,
+    GEMINI_RETRY_BUDGET_PER_RUN,
+    SUPABASE_RETRY_BUDGET_PER_RUN,
+    CIRCUIT_WINDOW_SECONDS,
+    CIRCUIT_MIN_CALLS,
+    CIRCUIT_FAILURE_RATE,
+    CIRCUIT_COOLDOWN_SECONDS,
+    CIRCUIT_MAX_WAIT_SECONDS,
+)
+from metrics import metrics
+import structured_log as log
+
+# 再試行すれば成功しうる HTTP ステータス
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+# 再試行すれば成功しうる PostgreSQL のエラーコード (直列化失敗・デッドロック・文の取り消し・接続数超過など)
+RETRYABLE_POSTGRES_CODES = {"40001", "40P01", "57014", "53300", "08000", "08003", "08006"}
+# 接続・タイムアウト系の例外 (httpx などはクラス名で判定し、依存を増やさない)
+RETRYABLE_EXCEPTION_NAMES = {"TransportError", "TimeoutException", "RemoteDisconnected"}
+
+
+class CircuitOpenError(ConnectionError):
+    """サーキットブレーカーが呼び出しを止めている間に、待ち時間の上限を超えた"""
+
+
+def _status_code(error):
+    for candidate in (getattr(error, "code", None), getattr(error, "status_code", None),
+                      getattr(getattr(error, "response", None), "status_code", None)):
+        if isinstance(candidate, int):
+            return candidate
+        if isinstance(candidate, str) and candidate.isdigit() and len(candidate) == 3:
+            return int(candidate)
+    return None
+
+
+def is_retryable(error):
+    """一時的なエラー (再試行すれば成功しうる) なら True、入力や権限の誤りなど再試行しても無駄なら False"""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if any(cls.__name__ in RETRYABLE_EXCEPTION_NAMES for cls in type(error).__mro__):
+        return True
+    if getattr(error, "code", None) in RETRYABLE_POSTGRES_CODES:
+        return True
+    return _status_code(error) in RETRYABLE_STATUS_CODES
+
+
+def raise_if_transient(error):
+    """
+    サービス関数の except 節で使う。一時的なエラーなら送出し直し、ユーザー単位の失敗として次回の実行で再処理させる。
+    それ以外のエラーは呼び出し側がエラー用の既定値に置き換える。
+    """
+    if is_retryable(error):
+        raise error
+
+
+def _parse_duration(value):
+    """Retry-After ("12" または HTTP 日付) や RetryInfo の retryDelay ("12s") を秒数にする"""
+    value = str(value).strip()
+    try:
+        return float(value[:-1] if value.endswith("s") else value)
+    except ValueError:
+        pass
+    try:
+        return (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after_seconds(error):
+    """エラーに含まれる再試行までの待ち時間 (Retry-After ヘッダーか Google API の RetryInfo) を返す。なければ None"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is not None and headers.get("Retry-After") is not None:
+        return _parse_duration(headers.get("Retry-After"))
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        for detail in (details.get("error") or {}).get("details") or []:
+            if isinstance(detail, dict) and "retryDelay" in detail:
+                return _parse_duration(detail["retryDelay"])
+    return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """attempt 回目の失敗後に待つ秒数。フルジッターの指数バックオフで、Retry-After があればそれ以上待つ"""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1)))
+    if retry_after is not None and retry_after > 0:
+        delay = max(delay, min(retry_after, RETRY_AFTER_MAX_SECONDS))
+    return delay
+
+
+class RetryBudget:
+    """1回の実行で許す再試行回数の上限。障害時に再試行が積み重なって実行が長引くのを防ぐ"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def try_spend(self):
+        with self._lock:
+            if self._used >= self.limit:
+                return False
+            self._used += 1
+            return True
+
+    def remaining(self):
+        with self._lock:
+            return self.limit - self._used
+
+    def reset(self):
+        with self._lock:
+            self._used = 0
+
+
+class CircuitBreaker:
+    """
+    直近 window_seconds 秒の一時的なエラーの割合が failure_rate を超えたら、cooldown_seconds 秒のあいだ呼び出しを止める。
+    最初に遮断したときは呼び出しを before_call で待たせ、再開後は1件ずつの試験的な呼び出しの結果を待つ。
+    試験的な呼び出しも失敗した (障害が続いている) 場合は、次の再開まで待たずに CircuitOpenError で失敗させる。
+    half_open の間は、試験的な呼び出しとして許可した呼び出しの結果だけで状態を決める
+    (遮断前に始まって遅れて終わった呼び出しの結果は使わない)。
+    """
+
+    def __init__(self, name, failure_rate=CIRCUIT_FAILURE_RATE, min_calls=CIRCUIT_MIN_CALLS,
+                 window_seconds=CIRCUIT_WINDOW_SECONDS, cooldown_seconds=CIRCUIT_COOLDOWN_SECONDS):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self._events = deque()
+        self._failures = 0
+        self._state = "closed"
+        self._open_until = 0.0
+        self._probe_in_flight = False
+        self._failed_probes = 0
+        self._cond = threading.Condition()
+
+    @property
+    def state(self):
+        return self._state
+
+    def before_call(self, max_wait_seconds=CIRCUIT_MAX_WAIT_SECONDS):
+        """
+        呼び出してよい状態になるまで待つ。max_wait_seconds を超えても再開しなければ CircuitOpenError。
+        試験的な呼び出しとして許可した場合は True を返し、呼び出し側はそれを record の probe に渡す。
+        """
+        started = None
+        probe = False
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._state == "closed":
+                    break
+                if self._state == "open" and now >= self._open_until:
+                    self._state = "half_open"
+                if self._state == "half_open" and not self._probe_in_flight:
+                    self._probe_in_flight = True
+                    probe = True
+                    break
+                started = started or now
+                remaining = started + max_wait_seconds - now
+                if remaining <= 0 or (self._state == "open" and self._failed_probes):
+                    metrics.incr(f"circuit.{self.name}.rejected")
+                    raise CircuitOpenError(f"circuit for {self.name} is open")
+                timeout = self._open_until - now if self._state == "open" else self.cooldown_seconds
+                self._cond.wait(min(timeout, remaining))
+        if started is not None:
+            metrics.observe(f"circuit.{self.name}.wait", time.monotonic() - started)
+        return probe
+
+    def record(self, failed, probe=False):
+        """
+        呼び出し結果を記録する。failed は一時的なエラーで失敗したかどうか、
+        probe はその呼び出しを before_call が試験的な呼び出しとして許可したかどうか
+        """
+        with self._cond:
+            now = time.monotonic()
+            if probe:
+                self._probe_in_flight = False
+                if failed:
+                    self._failed_probes += 1
+                    self._open(now)
+                else:
+                    self._state = "closed"
+                    self._events.clear()
+                    self._failures = 0
+                    self._failed_probes = 0
+                    log.info("Circuit closed", circuit=self.name)
+                self._cond.notify_all()
+                return
+            if self._state != "closed":
+                return
+            self._events.append((now, failed))
+            self._failures += failed
+            while self._events and now - self._events[0][0] > self.window_seconds:
+                self._failures -= self._events.popleft()[1]
+            if len(self._events) >= self.min_calls and self._failures / len(self._events) >= self.failure_rate:
+                self._open(now)
+
+    def _open(self, now):
+        self._state = "open"
+        self._open_until = now + self.cooldown_seconds
+        metrics.incr(f"circuit.{self.name}.opened")
+        log.warning("Circuit opened", circuit=self.name, cooldown_seconds=self.cooldown_seconds,
+                    recent_calls=len(self._events), recent_failures=self._failures)
+        self._cond.notify_all()
+
+
+class ResiliencePolicy:
+    """依存先 (Gemini / Supabase) ごとの再試行・バックオフ・再試行予算・サーキットブレーカーをまとめたもの"""
+
+    def __init__(self, name, retry_budget, max_attempts=RETRY_MAX_ATTEMPTS):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.budget = RetryBudget(retry_budget)
+        self.breaker = CircuitBreaker(name)
+
+    def call(self, func, operation):
+        """
+        func() を呼び出し、一時的なエラーなら待ってから再試行する。
+        再試行しないエラー・試行回数の上限・再試行予算の枯渇のいずれかで最後の例外を送出する。
+        """
+        attempt = 0
+        while True:
+            # 再試行予算が尽きている間は、遮断中の依存先の再開を待たずに失敗させる
+            probe = self.breaker.before_call(CIRCUIT_MAX_WAIT_SECONDS if self.budget.remaining() > 0 else 0)
+            try:
+                result = func()
+            except Exception as e:
+                retryable = is_retryable(e)
+                self.breaker.record(failed=retryable, probe=probe)
+                attempt += 1
+                if not retryable or attempt >= self.max_attempts:
+                    raise
+                if not self.budget.try_spend():
+                    metrics.incr(f"retry.{self.name}.budget_exhausted")
+                    raise
+                delay = backoff_delay(attempt, retry_after_seconds(e))
+                metrics.incr(f"retry.{self.name}.retries")
+                log.warning("Retrying after transient error", dependency=self.name, operation=operation,
+                            attempt=attempt, delay_seconds=round(delay, 2), error=str(e))
+                time.sleep(delay)
+                continue
+            self.breaker.record(failed=False, probe=probe)
+            return result
+
+
+gemini_policy = ResiliencePolicy("gemini", GEMINI_RETRY_BUDGET_PER_RUN)
+supabase_policy = ResiliencePolicy("supabase", SUPABASE_RETRY_BUDGET_PER_RUN)
+
+
+def reset_retry_budgets():
+    """実行の開始時に再試行予算を戻す (サーキットブレーカーの状態は呼び出しをまたいで引き継ぐ)"""
+    gemini_policy.budget.reset()
+    supabase_policy.budget.reset()
@@ -0,0 +1,73 @@
+from dataclasses import dataclass
+
+from config import (
+    PROMPT_TOKEN_BUDGET,
+    ROUTING_POLICY,
+    MODEL_LIGHT,
+    MODEL_STANDARD,
+    MODEL_LONG_CONTEXT,
+    ROUTING_LIGHT_MAX_TOKENS,
+    ROUTING_SKIP_INSIGHTS_MAX_TOKENS,
+    ROUTING_LONG_CONTEXT_TOKEN_BUDGET,
+    ROUTING_LIGHT_MAX_OUTPUT_TOKENS,
+)
+
+# ルーティングの対象になる生成タスク (gemini_client の service 名と同じ)
+TASKS = ("report", "quiz", "insights", "combined")
+
+
+@dataclass(frozen=True)
+class Route:
+    """1つの生成タスクに使うモデルと生成設定"""
+    task: str
+    tier: str  # "light" / "standard" / "long_context"
+    model: str
+    token_budget: int  # 会話履歴部分のトークン上限 (encode_conversation に渡す)
+    max_output_tokens: int = None
+    skip: bool = False  # True ならこのタスクは生成しない
+
+    @property
+    def generation_settings(self):
+        """GenerateContentConfig に追加で渡す設定"""
+        return {"max_output_tokens": self.max_output_tokens} if self.max_output_tokens else {}
+
+    def as_dict(self):
+        return {"tier": self.tier, "model": self.model, "token_budget": self.token_budget,
+                "max_output_tokens": self.max_output_tokens, "skip": self.skip}
+
+
+def conversation_tier(encoded):
+    """
+    標準の予算でエンコードした会話履歴 (EncodedConversation) から、その日の生成に使う区分を決める。
+    間引きが発生した日は long_context、短い日は light、それ以外は standard。
+    """
+    if ROUTING_POLICY == "fixed":
+        return "standard"
+    if encoded.dropped_turns:
+        return "long_context"
+    if encoded.tokens <= ROUTING_LIGHT_MAX_TOKENS:
+        return "light"
+    return "standard"
+
+
+def route_for(task, encoded):
+    """タスクと会話量に応じた Route を返す"""
+    tier = conversation_tier(encoded)
+    if tier == "light":
+        return Route(task, tier, MODEL_LIGHT, PROMPT_TOKEN_BUDGET,
+                     max_output_tokens=ROUTING_LIGHT_MAX_OUTPUT_TOKENS.get(task),
+                     skip=task == "insights" and encoded.tokens <= ROUTING_SKIP_INSIGHTS_MAX_TOKENS)
+    if tier == "long_context":
+        # 標準の予算では間引かれてしまう日は、長いコンテキストを扱えるモデルで間引かずに送る
+        return Route(task, tier, MODEL_LONG_CONTEXT, ROUTING_LONG_CONTEXT_TOKEN_BUDGET)
+    return default_route(task)
+
+
+def default_route(task):
+    """ルーティングを使わない呼び出し用の標準の Route"""
+    return Route(task, "standard", MODEL_STANDARD, PROMPT_TOKEN_BUDGET)
+
+
+def choose_routes(encoded):
+    """全タスクの Route を {task: Route} で返す"""
+    return {task: route_for(task, encoded) for task in TASKS}
@@ -0,0 +1,73 @@
+import uuid
+from datetime import datetime, timezone
+
+from activity_loader import chunked
+from config import ACTIVITY_FETCH_KEY_CHUNK_SIZE, RUN_STATUS_TABLE
+from resilience import supabase_policy
+
+STATUS_IN_PROGRESS = "in_progress"
+STATUS_SUCCEEDED = "succeeded"
+STATUS_FAILED = "failed"
+
+
+def new_run_id():
+    return uuid.uuid4().hex
+
+
+class RunTracker:
+    """
+    (user_id, run_date) ごとの処理状況を記録し、再実行時に未完了・失敗ユーザーだけを処理できるようにする。
+    前提: RUN_STATUS_TABLE に (user_id, run_date) のユニーク制約があること。
+    """
+
+    def __init__(self, supabase, run_date, run_id):
+        self.supabase = supabase
+        self.run_date = run_date
+        self.run_id = run_id
+
+    def load_statuses(self, user_ids):
+        """指定ユーザーの当日の処理状況を {user_id: status} で返す"""
+        statuses = {}
+        for chunk in chunked(list(user_ids), ACTIVITY_FETCH_KEY_CHUNK_SIZE):
+            res = self.supabase.table(RUN_STATUS_TABLE) \
+                .select('user_id, status') \
+                .eq('run_date', self.run_date) \
+                .in_('user_id', chunk) \
+                .execute()
+            for row in res.data or []:
+                statuses[row['user_id']] = row['status']
+        return statuses
+
+    def pending_user_ids(self, user_ids):
+        """まだ成功していないユーザーだけを入力順のまま返す"""
+        statuses = self.load_statuses(user_ids)
+        return [user_id for user_id in user_ids if statuses.get(user_id) != STATUS_SUCCEEDED]
+
+    def _row(self, user_id, status, task_folder_id=None, error_details=None):
+        # 複数行の upsert では全行のカラムをそろえる必要があるため、値がなくてもキーを含める
+        return {
+            "user_id": user_id,
+            "run_date": self.run_date,
+            "run_id": self.run_id,
+            "status": status,
+            "task_folder_id": task_folder_id,
+            "error_details": error_details,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }
+
+    def mark_started(self, user_ids):
+        """処理対象ユーザーをまとめて in_progress にする"""
+        for chunk in chunked(list(user_ids), ACTIVITY_FETCH_KEY_CHUNK_SIZE):
+            rows = [self._row(user_id, STATUS_IN_PROGRESS) for user_id in chunk]
+            self._upsert(rows)
+
+    def mark_many(self, updates):
+        """(user_id, status, task_folder_id, error_details) のリストをまとめて反映する"""
+        rows = [self._row(*update) for update in updates]
+        for chunk in chunked(rows, ACTIVITY_FETCH_KEY_CHUNK_SIZE):
+            self._upsert(chunk)
+
+    def _upsert(self, rows):
+        # upsert は何度実行しても同じ結果になるため、一時的なエラーはそのまま再試行する
+        query = self.supabase.table(RUN_STATUS_TABLE).upsert(rows, on_conflict='user_id,run_date')
+        supabase_policy.call(query.execute, operation="record_run_status")
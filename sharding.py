@@ -0,0 +1,103 @@
+import heapq
+import json
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from config import SHARD_WORKER_URL, SHARD_DISPATCH_TIMEOUT_SECONDS
+import structured_log as log
+
+METADATA_IDENTITY_URL = "http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/identity"
+
+
+def estimate_user_load(activity):
+    """ユーザーの活動量から Gemini に送るトークン量を概算する (シャードの負荷分散用)"""
+    chars = sum(len(str(msg.get('content') or '')) for msg in activity["messages"])
+    chars += sum(len(str(post.get('comment') or '')) for post in activity["posts"])
+    chars += sum(len(str(ai_msg.get('content') or '')) for ai_msg in activity["post_messages_to_ai"])
+    # 会話が短くても出力やプロンプトの固定部分があるため、ユーザーごとに一定の下駄を履かせる
+    return 1000 + chars // 2
+
+
+def partition_by_count(user_ids, shard_count):
+    """ユーザー数が均等になるように分割する"""
+    shards = [[] for _ in range(shard_count)]
+    for i, user_id in enumerate(user_ids):
+        shards[i % shard_count].append(user_id)
+    return shards
+
+
+def partition_by_load(user_ids, loads, shard_count):
+    """推定負荷の大きいユーザーから、その時点で最も負荷の小さいシャードに割り当てる (LPT法)"""
+    shards = [[] for _ in range(shard_count)]
+    heap = [(0, index) for index in range(shard_count)]
+    for user_id in sorted(user_ids, key=lambda u: loads.get(u, 0), reverse=True):
+        total, index = heapq.heappop(heap)
+        shards[index].append(user_id)
+        heapq.heappush(heap, (total + loads.get(user_id, 0), index))
+    return shards
+
+
+def build_shard_specs(shards, loads=None):
+    """ワーカーのリクエストボディに載せるシャード指定を作る (空のシャードは除く)"""
+    non_empty = [shard for shard in shards if shard]
+    return [
+        {
+            "index": index,
+            "count": len(non_empty),
+            "user_ids": shard,
+            "estimated_load": sum(loads.get(u, 0) for u in shard) if loads else None,
+        }
+        for index, shard in enumerate(non_empty)
+    ]
+
+
+def _fetch_id_token(audience):
+    """メタデータサーバーから呼び出し先 (自分自身の関数URL) 向けの ID トークンを取得する"""
+    url = f"{METADATA_IDENTITY_URL}?{urllib.parse.urlencode({'audience': audience})}"
+    req = urllib.request.Request(url, headers={"Metadata-Flavor": "Google"})
+    with urllib.request.urlopen(req, timeout=10) as res:
+        return res.read().decode("utf-8")
+
+
+def http_dispatcher(worker_url=SHARD_WORKER_URL, timeout=SHARD_DISPATCH_TIMEOUT_SECONDS):
+    """
+    ワーカー呼び出しを HTTP で行う dispatcher を返す。
+    関数は --no-allow-unauthenticated でデプロイされているため、実行サービスアカウントに
+    自分自身への roles/cloudfunctions.invoker (gen2 では run.invoker) が必要。
+    """
+    if not worker_url:
+        raise ValueError("SHARD_WORKER_URL is not set; cannot dispatch shards over HTTP.")
+
+    def dispatch(body):
+        token = _fetch_id_token(worker_url)
+        req = urllib.request.Request(
+            worker_url,
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json", "Authorization": f"Bearer {token}"},
+            method="POST",
+        )
+        with urllib.request.urlopen(req, timeout=timeout) as res:
+            return res.status, json.loads(res.read().decode("utf-8"))
+
+    return dispatch
+
+
+def dispatch_shards(shard_specs, base_body, dispatcher, max_parallel=None):
+    """
+    各シャードを worker モードのリクエストとして並列に送り、シャードごとの結果を返す。
+    dispatcher(body) は (HTTPステータス, レスポンスJSON) を返す関数。
+    """
+    def run(spec):
+        body = dict(base_body, mode="worker", shard=spec)
+        try:
+            status, payload = dispatcher(body)
+            return {"shard": spec["index"], "status": status, "response": payload}
+        except Exception as e:
+            log.error("Shard dispatch failed", shard=spec['index'], error=str(e))
+            return {"shard": spec["index"], "status": None, "error": str(e)}
+
+    if not shard_specs:
+        return []
+    with ThreadPoolExecutor(max_workers=max_parallel or len(shard_specs)) as executor:
+        return list(executor.map(run, shard_specs))
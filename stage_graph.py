@@ -0,0 +1,63 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+class StageGraph:
+    """依存関係を持つステージを、依存が満たされたものから並列に実行する小さなDAGランナー"""
+
+    def __init__(self):
+        self._stages = {}
+
+    def add(self, name, func, depends_on=()):
+        """
+        ステージを登録する。
+        func には depends_on に並べたステージの結果がその順で位置引数として渡される。
+        """
+        for dep in depends_on:
+            if dep not in self._stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dep}'")
+        self._stages[name] = (func, tuple(depends_on))
+
+    def run(self, executor):
+        """
+        全ステージを executor 上で実行し、(results, latencies) を返す。
+        latencies は各ステージの実行時間 (秒)。いずれかのステージが例外を出した場合、
+        それに依存するステージは実行せず、実行中のステージの完了を待ってから最初の例外を送出する。
+        """
+        results = {}
+        latencies = {}
+        pending = dict(self._stages)
+        running = {}
+        first_error = None
+
+        def timed(name, func, args):
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                latencies[name] = time.perf_counter() - started
+
+        while pending or running:
+            if first_error is None:
+                for name, (func, deps) in list(pending.items()):
+                    if all(dep in results for dep in deps):
+                        args = tuple(results[dep] for dep in deps)
+                        running[executor.submit(timed, name, func, args)] = name
+                        del pending[name]
+            elif pending:
+                pending.clear()
+
+            if not running:
+                break
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    if first_error is None:
+                        first_error = e
+
+        if first_error is not None:
+            raise first_error
+        return results, latencies
@@ -0,0 +1,64 @@
+import json
+import sys
+import traceback
+import zlib
+
+from config import LOG_LEVEL, LOG_PAYLOAD_SAMPLE_RATE, LOG_PAYLOAD_MAX_CHARS
+
+_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+_threshold = _LEVELS.get(LOG_LEVEL.upper(), 20)
+
+
+def enabled(severity):
+    return _LEVELS[severity] >= _threshold
+
+
+def _emit(severity, message, fields):
+    if not enabled(severity):
+        return
+    # Cloud Logging は stdout の1行JSONを構造化ログとして取り込み、severity / message を認識する
+    entry = {"severity": severity, "message": message}
+    entry.update(fields)
+    sys.stdout.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+
+
+def debug(message, **fields):
+    _emit("DEBUG", message, fields)
+
+
+def info(message, **fields):
+    _emit("INFO", message, fields)
+
+
+def warning(message, **fields):
+    _emit("WARNING", message, fields)
+
+
+def error(message, exc_info=False, **fields):
+    if exc_info:
+        fields["traceback"] = traceback.format_exc()
+    _emit("ERROR", message, fields)
+
+
+def _truncate(text, limit=LOG_PAYLOAD_MAX_CHARS):
+    return text if len(text) <= limit else text[:limit] + f"…(+{len(text) - limit} chars)"
+
+
+def is_sampled(sample_key, rate=LOG_PAYLOAD_SAMPLE_RATE):
+    """sample_key (ユーザーIDなど) ごとに決定的に抽出する。同じユーザーのペイロードはまとめて残る"""
+    if rate >= 1:
+        return True
+    if rate <= 0:
+        return False
+    return zlib.crc32(str(sample_key).encode("utf-8")) % 10_000 < rate * 10_000
+
+
+def payload(message, data, sample_key=None, **fields):
+    """
+    会話JSONや生成結果などの大きなペイロードを、DEBUG レベルかつ抽出対象のときだけ切り詰めて出力する。
+    抽出されなければシリアライズ自体を行わない。
+    """
+    if not enabled("DEBUG") or not is_sampled(sample_key):
+        return
+    text = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False, default=str)
+    _emit("DEBUG", message, dict(fields, payload=_truncate(text), payload_chars=len(text)))
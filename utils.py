@@ -1,28 +1,33 @@
 import os
+import threading
 from google.cloud import secretmanager
-from google import genai
 import config
-import traceback
+import structured_log as log
 
-secret_client = secretmanager.SecretManagerServiceClient()
+# Secret Manager クライアントは初回のシークレット取得時に作成する (import 時の初期化を避ける)
+_secret_client = None
+_secret_client_lock = threading.Lock()
+
+def _get_secret_client():
+    global _secret_client
+    with _secret_client_lock:
+        if _secret_client is None:
+            _secret_client = secretmanager.SecretManagerServiceClient()
+        return _secret_client
 
 def get_secret(secret_id):
     """Secret Manager から指定されたシークレットの最新バージョンを取得する"""
     current_project_id = os.environ.get("GCP_PROJECT", config.PROJECT_ID)
     if not current_project_id:
-         print("ERROR: GCP_PROJECT cannot be determined.")
+         log.error("GCP_PROJECT cannot be determined")
          raise ValueError("GCP_PROJECT cannot be determined.")
 
     name = f"projects/{current_project_id}/secrets/{secret_id}/versions/latest"
 
     try:
-        response = secret_client.access_secret_version(request={"name": name})
-        print(f"Successfully accessed secret: {secret_id}")
+        response = _get_secret_client().access_secret_version(request={"name": name})
+        log.debug("Accessed secret", secret_id=secret_id)
         return response.payload.data.decode("UTF-8")
     except Exception as e:
-        print(f"Error accessing secret {secret_id}: {e}")
-        traceback.print_exc()
+        log.error("Error accessing secret", exc_info=True, secret_id=secret_id, error=str(e))
         raise
-
-api_key = get_secret(config.GEMINI_API_KEY_SECRET_ID)
-client = genai.Client(api_key=api_key) 
\ No newline at end of file
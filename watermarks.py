@@ -0,0 +1,81 @@
+import threading
+from datetime import datetime, timezone
+
+from activity_loader import chunked, position
+from config import ACTIVITY_FETCH_KEY_CHUNK_SIZE, WATERMARK_TABLE
+from metrics import metrics
+from resilience import supabase_policy
+
+
+class WatermarkStore:
+    """
+    (user_id, source) ごとの処理済み位置 (created_at, id) を保存し、incremental モードの取得開始位置に使う。
+    前提: WATERMARK_TABLE に (user_id, source) のユニーク制約があり、last_id が NULL を許すこと。
+    last_id が NULL の位置は、last_created_at までの行をすべて処理済みであることを表す (取得範囲の終端まで進めた位置)。
+    last_id が 0 の位置は、last_created_at の時刻の行から未処理であることを表す (pin で固定した開始位置)。
+    位置は前にしか進めない (backfill で古い日を処理しても巻き戻らない)。
+    """
+
+    def __init__(self, supabase):
+        self.supabase = supabase
+        self._marks = {}
+        self._lock = threading.Lock()
+
+    def load(self, user_ids):
+        """指定ユーザーの処理済み位置を {user_id: {source: (created_at, id)}} で返す"""
+        marks = {}
+        for chunk in chunked(list(user_ids), ACTIVITY_FETCH_KEY_CHUNK_SIZE):
+            res = self.supabase.table(WATERMARK_TABLE) \
+                .select('user_id, source, last_created_at, last_id') \
+                .in_('user_id', chunk) \
+                .execute()
+            for row in res.data or []:
+                marks.setdefault(row['user_id'], {})[row['source']] = (row['last_created_at'], row['last_id'])
+        with self._lock:
+            for user_id, user_marks in marks.items():
+                self._marks.setdefault(user_id, {}).update(user_marks)
+        return marks
+
+    def advance(self, marks_by_user):
+        """
+        {user_id: {source: (created_at, id)}} のうち、load 済みの位置より新しいものだけを書き込む。
+        書き込んだ行数を返す。
+        """
+        updated_at = datetime.now(timezone.utc).isoformat()
+        rows = []
+        with self._lock:
+            for user_id, marks in marks_by_user.items():
+                current = self._marks.get(user_id, {})
+                for source, (created_at, row_id) in marks.items():
+                    existing = current.get(source)
+                    if existing is not None and position(*existing) >= position(created_at, row_id):
+                        continue
+                    rows.append({
+                        "user_id": user_id,
+                        "source": source,
+                        "last_created_at": created_at,
+                        "last_id": row_id,
+                        "updated_at": updated_at,
+                    })
+        for chunk in chunked(rows, ACTIVITY_FETCH_KEY_CHUNK_SIZE):
+            query = self.supabase.table(WATERMARK_TABLE).upsert(chunk, on_conflict='user_id,source')
+            supabase_policy.call(query.execute, operation="advance_watermarks")
+        # 書き込みに成功してから手元の位置を進める (失敗した分は次の advance で再度書き込む)
+        with self._lock:
+            for row in rows:
+                self._marks.setdefault(row["user_id"], {})[row["source"]] = (row["last_created_at"], row["last_id"])
+        metrics.incr("watermarks.advanced", len(rows))
+        return len(rows)
+
+    def pin(self, user_ids, sources, created_at):
+        """
+        user_ids のうち位置のないテーブルにだけ、created_at 以降の行を未処理とする位置を書き込む。
+        処理を見送ったユーザーの開始位置を固定し、既定の開始位置が進んで古い行が取得範囲から外れないようにする。
+        書き込んだ行数を返す。
+        """
+        with self._lock:
+            marks = {
+                user_id: {source: (created_at, 0) for source in sources if source not in self._marks.get(user_id, {})}
+                for user_id in user_ids
+            }
+        return self.advance(marks)
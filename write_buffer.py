@@ -0,0 +1,178 @@
+import threading
+import time
+
+from activity_loader import chunked
+from config import WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL_SECONDS, ACTIVITY_FETCH_KEY_CHUNK_SIZE
+from metrics import metrics
+import structured_log as log
+from resilience import supabase_policy
+
+
+class PendingUserWrite:
+    """
+    1ユーザー分の書き込み内容。
+    task_rows と report_row には task_folder_id を含めず、フォルダ作成後にバッファ側で埋める。
+    result は run_user_tasks が返した結果で、書き込みの成否をここに書き戻す。
+    folder_row が None のエントリ (保存するもののないユーザー) は何も書き込まず、on_flushed に結果だけを渡す。
+    """
+
+    def __init__(self, user_id, folder_row, task_rows, report_row, result):
+        self.user_id = user_id
+        self.folder_row = folder_row
+        self.task_rows = task_rows
+        self.report_row = report_row
+        self.result = result
+        self.task_folder_id = None
+        self.errors = []
+
+
+class DailyWriteBuffer:
+    """
+    user_task_folders / user_tasks / user_daily_report への書き込みをユーザーをまたいで溜め、
+    batch_size 人分たまるか flush_interval_seconds が経過するごとに複数行まとめて書き込む。
+    一括書き込みが失敗した場合はユーザーごとに書き直し、失敗したユーザーだけをエラーにする。
+    書き込みが終わるたびに on_flushed(entries) を呼ぶ。
+    """
+
+    def __init__(self, supabase, batch_size=WRITE_BATCH_SIZE, flush_interval_seconds=WRITE_FLUSH_INTERVAL_SECONDS,
+                 on_flushed=None):
+        self.supabase = supabase
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.on_flushed = on_flushed
+        self._pending = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_periodically, name="write-buffer-flusher", daemon=True)
+        self._flusher.start()
+
+    def add(self, entry):
+        with self._cond:
+            self._pending.append(entry)
+            should_flush = len(self._pending) >= self.batch_size
+        if should_flush:
+            self.flush()
+
+    def close(self):
+        """定期フラッシュを止め、残りをすべて書き込む"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._flusher.join()
+        self.flush()
+
+    def _flush_periodically(self):
+        while True:
+            with self._cond:
+                self._cond.wait(timeout=self.flush_interval_seconds)
+                if self._closed:
+                    return
+            self.flush()
+
+    def flush(self):
+        with self._cond:
+            entries, self._pending = self._pending, []
+        if not entries:
+            return
+        with self._flush_lock:
+            for batch in chunked(entries, self.batch_size):
+                started = time.perf_counter()
+                self._write_batch(batch)
+                elapsed = time.perf_counter() - started
+                metrics.incr("writes.flushes")
+                metrics.incr("writes.users", sum(1 for e in batch if e.folder_row is not None))
+                metrics.incr("writes.flush_seconds", elapsed)
+                metrics.observe("write.flush", elapsed)
+                log.debug("Flushed writes", num_users=len(batch), seconds=round(elapsed, 3))
+                if self.on_flushed is not None:
+                    try:
+                        self.on_flushed(batch)
+                    except Exception as e:
+                        log.error("on_flushed callback failed", exc_info=True, error=str(e))
+
+    def _execute(self, query):
+        metrics.incr("writes.round_trips")
+        return query.execute()
+
+    def _write_with_fallback(self, stage, entries, rows_for, write):
+        """
+        entries の行をまとめて write し、失敗した場合は1ユーザーずつ書き直す。
+        write(rows) は書き込んだ行のリストを返し、失敗時は例外を送出する。
+        一時的なエラーは write 単位で再試行する (問題の保存は削除と挿入をまとめてやり直すため重複しない)。
+        """
+        def write_with_retry(rows):
+            return supabase_policy.call(lambda: write(rows), operation=stage)
+
+        entries = [e for e in entries if rows_for(e)]
+        if not entries:
+            return []
+        try:
+            return write_with_retry([row for e in entries for row in rows_for(e)])
+        except Exception as e:
+            log.warning("Batched write failed, retrying per user", stage=stage, num_users=len(entries), error=str(e))
+        written = []
+        for entry in entries:
+            try:
+                written.extend(write_with_retry(rows_for(entry)))
+            except Exception as e:
+                log.error("Write failed", stage=stage, user_id=entry.user_id, error=str(e))
+                entry.errors.append(f"{stage}: {e}")
+        return written
+
+    def _upsert_folders(self, rows):
+        # 再実行時に同じ日のフォルダを重複作成しないよう (user_id, title) で upsert する
+        res = self._execute(self.supabase.table("user_task_folders").upsert(rows, on_conflict='user_id,title'))
+        if not res.data:
+            raise RuntimeError(f"Failed to create task folders. Response: {res}")
+        return res.data
+
+    def _replace_tasks(self, rows):
+        # 前回の未完了の実行で保存された問題があれば置き換える (これらのフォルダはまだ完了扱いになっていない)
+        folder_ids = sorted({row["task_folder_id"] for row in rows})
+        for chunk in chunked(folder_ids, ACTIVITY_FETCH_KEY_CHUNK_SIZE):
+            self._execute(self.supabase.table("user_tasks").delete().in_('task_folder_id', chunk))
+        res = self._execute(self.supabase.table("user_tasks").insert(rows))
+        if not res.data:
+            raise RuntimeError(f"Failed to insert tasks. Response: {res}")
+        return res.data
+
+    def _upsert_reports(self, rows):
+        # フォルダごとに1件のレポートとし、再実行時は上書きする
+        res = self._execute(self.supabase.table("user_daily_report").upsert(rows, on_conflict='task_folder_id'))
+        if not res.data:
+            raise RuntimeError(f"Failed to insert daily reports. Response: {res}")
+        return res.data
+
+    def _write_batch(self, batch):
+        writable = [e for e in batch if e.folder_row is not None]
+        # --- 1. タスクフォルダの作成 (返ってきた id を各ユーザーに割り当てる) ---
+        folders = self._write_with_fallback("create_task_folder", writable, lambda e: [e.folder_row],
+                                            self._upsert_folders)
+        folder_ids = {(row['user_id'], row['title']): row['id'] for row in folders}
+        for entry in writable:
+            entry.task_folder_id = folder_ids.get((entry.user_id, entry.folder_row['title']))
+            if entry.task_folder_id is None and not entry.errors:
+                entry.errors.append("create_task_folder: Failed to create task folder")
+
+        # フォルダが作れなかったユーザーは以降の書き込みを行わない
+        with_folder = [e for e in writable if e.task_folder_id is not None]
+        for entry in with_folder:
+            for row in entry.task_rows:
+                row["task_folder_id"] = entry.task_folder_id
+            entry.report_row["task_folder_id"] = entry.task_folder_id
+
+        # --- 2. デイリークイズの保存 (user_tasks) ---
+        self._write_with_fallback("save_tasks", with_folder, lambda e: e.task_rows, self._replace_tasks)
+        # --- 3. 日次レポートの保存 (user_daily_report) ---
+        self._write_with_fallback("save_report", with_folder, lambda e: [e.report_row], self._upsert_reports)
+
+        # 書き込み結果を各ユーザーの result に反映する
+        for entry in writable:
+            entry.result["task_folder_id"] = entry.task_folder_id
+            if entry.errors:
+                entry.result.update({
+                    "status": "error",
+                    "error_details": "; ".join(entry.errors),
+                    "stage": entry.errors[0].split(":", 1)[0],
+                })